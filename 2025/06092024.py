@@ -1,7 +1,10 @@
 import numpy as np
 import random
 import hashlib
+import json
 import multiprocessing
+import queue as queue_module
+import time
 from midiutil import MIDIFile
 
 # Define possible notes in a scale (C major) with probabilities
@@ -36,17 +39,21 @@ def generate_chord_progression(length):
 def generate_rhythmic_pattern(length):
     return np.random.choice(durations, size=length, p=duration_probabilities).tolist()
 
-# Apply transformations
+# Apply transformations with static pitch-class tables, built once:
+# TRANSPOSE_TABLE[n][pc] = pc + n and INVERT_TABLE[n][pc] = n - pc (mod
+# 12), spelled as note names
+note_index = {note: i for i, note in enumerate(notes)}
+TRANSPOSE_TABLE = [[notes[(pc + n) % 12] for pc in range(12)] for n in range(12)]
+INVERT_TABLE = [[notes[(n - pc) % 12] for pc in range(12)] for n in range(12)]
+
 def transpose(sequence, interval):
-    note_map = {note: i for i, note in enumerate(notes)}
-    transpose_map = {i: notes[(i + interval) % len(notes)] for i in range(len(notes))}
-    return [transpose_map[note_map[note]] for note in sequence]
+    row = TRANSPOSE_TABLE[interval % 12]
+    return [row[note_index[note]] for note in sequence]
 
+# Mirrors 0..11 onto 11..0 (I11)
 def invert(sequence):
-    note_map = {note: i for i, note in enumerate(notes)}
-    max_interval = max(note_map.values())
-    invert_map = {i: notes[max_interval - i] for i in range(len(notes))}
-    return [invert_map[note_map[note]] for note in sequence]
+    row = INVERT_TABLE[11]
+    return [row[note_index[note]] for note in sequence]
 
 def retrograde(sequence):
     return sequence[::-1]
@@ -183,9 +190,54 @@ hmm_emission_probabilities = {
 
 hmm = HMM(hmm_states, hmm_start_probabilities, hmm_transition_probabilities, hmm_emission_probabilities)
 
+# Work coordination: producers claim songs from the shared counter
+# `claimed` a quota at a time (duplicates are given back by the
+# consumer) and stop when the consumer sets `stop` at the target
+QUOTA = 4
+PUT_TIMEOUT = 0.1
+
+# Returns 0 only once the run is stopped: while target songs are
+# claimed but not all in, a duplicate may still be given back
+def claim_songs(claimed, target, n, stop):
+    while not stop.is_set():
+        with claimed.get_lock():
+            count = max(0, min(n, target - claimed.value))
+            claimed.value += count
+        if count:
+            return count
+        stop.wait(PUT_TIMEOUT)
+    return 0
+
+# Put an item, giving up if the run is stopped while the queue is full
+def put_until_stopped(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=PUT_TIMEOUT)
+            return True
+        except queue_module.Full:
+            pass
+    return False
+
+# Seed this process's np.random and random from its own SeedSequence.
+# Forked producers otherwise inherit one generator state and all make the
+# same songs; spawned sequences of one run seed give each an independent
+# stream, the same again when the run seed is replayed. np.random and
+# random are both MT19937, so each gets a child sequence of its own:
+# seeded from the same words they would produce the same numbers
+def seed_worker(seed):
+    np_seed, py_seed = seed.spawn(2)
+    np.random.seed(np_seed.generate_state(4))
+    random.seed(int.from_bytes(py_seed.generate_state(4).tobytes(), 'little'))
+
 # Generate unique songs using FSM
-def generate_unique_song(queue, fsm, pfa, hmm):
-    while True:
+def generate_unique_song(queue, fsm, pfa, hmm, claimed, target, stop, seed):
+    seed_worker(seed)
+    quota = 0
+    while not stop.is_set():
+        if not quota:
+            quota = claim_songs(claimed, target, QUOTA, stop)
+            if not quota:
+                break
         current_state = pfa.current_state
         if current_state == 'GenerateMelody':
             melody = [hmm.step() for _ in range(12)]
@@ -209,22 +261,56 @@ def generate_unique_song(queue, fsm, pfa, hmm):
             }
             # Create a unique hash for the song to ensure uniqueness
             song_hash = hashlib.sha256(str(song).encode()).hexdigest()
-            queue.put((song, song_hash))
+            if not put_until_stopped(queue, (song, song_hash), stop):
+                break
+            quota -= 1
             pfa.transition()
 
-# Consumer process to print songs and ensure uniqueness
-def consumer(queue, target, path):
+    # Songs still buffered for the queue are not needed once stopped;
+    # don't wait for them at exit
+    if stop.is_set():
+        queue.cancel_join_thread()
+
+# Consumer process to print songs and ensure uniqueness. Stops the
+# producers at target, drains the queue and reports the run. The run
+# seed is saved next to the songs for replay
+def consumer(queue, target, path, claimed, stop, run_seed):
+    with open(f"{path}/run.json", "w") as run_file:
+        json.dump({'seed': run_seed, 'target': target}, run_file)
     unique_songs = set()
     generated = 0
+    duplicates = 0
+    start_time = time.time()
 
     while generated < target:
-        song, song_hash = queue.get()
+        try:
+            song, song_hash = queue.get(timeout=PUT_TIMEOUT)
+        except queue_module.Empty:
+            if stop.is_set():
+                break
+            continue
         if song_hash not in unique_songs:
             unique_songs.add(song_hash)
             generated += 1
             # Save each song as a MIDI file
             save_midi(song, f"{path}/song_{generated}.mid")
             print(f"Song {generated} saved as MIDI")
+        else:
+            # Let a producer make another song in its place
+            duplicates += 1
+            with claimed.get_lock():
+                claimed.value -= 1
+
+    stop.set()
+    discarded = 0
+    while True:
+        try:
+            queue.get(timeout=PUT_TIMEOUT)
+            discarded += 1
+        except queue_module.Empty:
+            break
+    elapsed = time.time() - start_time
+    print(f"Run stats: {generated} songs, {duplicates} duplicates, {discarded} discarded, {elapsed:.1f} s")
 
 def save_midi(song, filename):
     midi = MIDIFile(1)
@@ -262,24 +348,38 @@ if __name__ == '__main__':
     num_producers = multiprocessing.cpu_count() - 1  # Use all but one core for producers
 
     queue = multiprocessing.Queue(maxsize=1000)
+    claimed = multiprocessing.Value('q', 0)
+    stop = multiprocessing.Event()
+
+    # Set to the seed of an earlier run (printed, and saved in run.json)
+    # to replay it
+    run_seed = None
+    if run_seed is None:
+        run_seed = np.random.SeedSequence().entropy
+    print(f"Run seed: {run_seed}")
+    seeds = np.random.SeedSequence(run_seed).spawn(num_producers)
 
     # Initialize FSM for each producer
-    fsms = [FSM(generate_melody_state) for _ in range(num_producers)]
+    fsms = [FSM(states['C']) for _ in range(num_producers)]
 
     # Create producer processes
-    producers = [multiprocessing.Process(target=generate_unique_song, args=(queue, fsms[i], pfa, hmm)) for i in range(num_producers)]
+    producers = [multiprocessing.Process(target=generate_unique_song, args=(queue, fsms[i], pfa, hmm, claimed, target, stop, seeds[i])) for i in range(num_producers)]
 
     # Create and start consumer process
-    consumer_process = multiprocessing.Process(target=consumer, args=(queue, target, path))
+    consumer_process = multiprocessing.Process(target=consumer, args=(queue, target, path, claimed, stop, run_seed))
     consumer_process.start()
 
     # Start producer processes
     for producer in producers:
         producer.start()
 
-    # Wait for producer processes to finish
+    # Wait for consumer process to finish; Ctrl-C stops the run as well
+    try:
+        consumer_process.join()
+    except KeyboardInterrupt:
+        stop.set()
+        consumer_process.join()
+
+    # Producers exit once the run is stopped
     for producer in producers:
         producer.join()
-
-    # Wait for consumer process to finish
-    consumer_process.join()
@@ -0,0 +1,205 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from ring_buffer import MIDI_EVENT
+from sync import SYNC_OUTPUT, SYNC_RUNNING, MidiClock, syncTimer
+from virtual_clock import VirtualClock
+
+
+#-----------------------------------------------------------------------------
+# Sync engine benchmark
+#
+# Drives sync() through the virtual clock with synthetic songs, so a run
+# measures the engine itself and not the timer. Each case queues nEvents
+# note events spread over nOutputs outputs and nTicks ticks, optionally
+# with tempo changes on the first output, and plays them out in S_INT or
+# S_MIDI mode (the latter from a simulated MIDI clock master). For each
+# case it reports:
+#
+#   events_per_sec      events played out per second of wall time
+#   mean_us / p99_us    cost of one sync() call
+#   bytes_per_event     memory allocated while queueing, per event
+#
+# The random song is seeded, so runs with the same arguments are
+# comparable. Results are written as JSON; --compare prints the change
+# against an earlier results file.
+#
+#   python bench_sync.py --outputs 1,16,64 --events 1000,100000 --json out.json
+#-----------------------------------------------------------------------------
+
+def MakeSong(rng, nEvents, nTicks, nChannel, nTempoChanges=0):
+    # Note on/off pairs at random ticks, as one MIDI_EVENT array
+    dwTicks = np.sort(rng.integers(0, nTicks, nEvents))
+    events = np.zeros(nEvents, dtype=MIDI_EVENT)
+    events["status"] = np.where(np.arange(nEvents) % 2 == 0, 0x90, 0x80) | nChannel
+    events["data1"] = rng.integers(36, 96, nEvents)
+    events["data2"] = np.where(events["status"] & 0xF0 == 0x90, 100, 0)
+
+    if nTempoChanges:
+        tempoTicks = np.linspace(0, nTicks, nTempoChanges + 2, dtype=np.int64)[1:-1]
+        uSPerBeat = np.where(np.arange(nTempoChanges) % 2 == 0, 400000, 500000)
+        tempos = np.zeros(nTempoChanges, dtype=MIDI_EVENT)
+        tempos["data1"] = uSPerBeat >> 16
+        tempos["data2"] = (uSPerBeat >> 8) & 0xFF
+        tempos["data3"] = uSPerBeat & 0xFF
+
+        dwTicks = np.concatenate((dwTicks, tempoTicks))
+        events = np.concatenate((events, tempos))
+        order = np.argsort(dwTicks, kind="stable")
+        dwTicks, events = dwTicks[order], events[order]
+
+    events["time"] = np.diff(dwTicks, prepend=0)
+    return events
+
+
+def BuildCase(nOutputs, nEvents, nTicks, mode, nTempoChanges, wTimerPeriod, seed):
+    rng = np.random.default_rng(seed)
+    vc = VirtualClock(mode, wTimerPeriod)
+
+    tracemalloc.start()
+    nBefore = tracemalloc.get_traced_memory()[0]
+    for nOutput in range(nOutputs):
+        nOutEvents = nEvents // nOutputs + (1 if nOutput < nEvents % nOutputs else 0)
+        song = MakeSong(rng, nOutEvents, nTicks, nOutput % 16, nTempoChanges if nOutput == 0 else 0)
+        lpMO = vc.AddOutput(max(len(song), 1), SYNC_OUTPUT if nOutput == 0 else 0)
+        lpMO.lpMidiOutData.Push(song)
+        del song
+    nBytes = tracemalloc.get_traced_memory()[0] - nBefore
+    tracemalloc.stop()
+
+    return vc, nBytes
+
+
+#-----------------------------------------------------------------------------
+# RunCase
+# Plays the song out, timing every sync() call. In S_MIDI mode a master
+# at 120 bpm sends a MIDI clock every 1/24 beat between the interrupts.
+#-----------------------------------------------------------------------------
+def RunCase(nOutputs, nEvents, nTicks, mode, nTempoChanges=0, wTimerPeriod=1, seed=0):
+    vc, nBytes = BuildCase(nOutputs, nEvents, nTicks, mode, nTempoChanges, wTimerPeriod, seed)
+    lpSync = vc.lpSync
+    vc.Start()
+    if mode == "S_MIDI":
+        # Started by the master's MIDI_START
+        lpSync.wFlags |= SYNC_RUNNING
+
+    costs = []
+    uSPerClock = 500000 / 24.0
+    uSNow = 0
+    nClock = 1
+    perf_counter_ns = time.perf_counter_ns
+    nsStart = perf_counter_ns()
+    while not lpSync.lpMidiOutList.AllEmpty() or lpSync.nSysexBuffsActive:
+        if mode == "S_MIDI" and nClock * uSPerClock <= uSNow:
+            ns = perf_counter_ns()
+            MidiClock(lpSync, int(nClock * uSPerClock * 1000))
+            costs.append(perf_counter_ns() - ns)
+            nClock += 1
+            continue
+
+        ns = perf_counter_ns()
+        syncTimer(None, 0, lpSync, 0, 0)
+        costs.append(perf_counter_ns() - ns)
+        uSNow += wTimerPeriod * 1000
+    nsTotal = perf_counter_ns() - nsStart
+
+    nSent = sum(len(lpMO.messages) for lpMO in vc.outputs)
+    vc.Close()
+
+    costs = np.array(costs, dtype=np.float64) / 1000.0
+    return {
+        "outputs": nOutputs,
+        "events": nEvents,
+        "ticks": nTicks,
+        "mode": mode,
+        "tempo_changes": nTempoChanges,
+        "timer_period": wTimerPeriod,
+        "sync_calls": len(costs),
+        "messages_sent": nSent,
+        "events_per_sec": nEvents / (nsTotal / 1e9) if nsTotal else 0.0,
+        "mean_us": float(costs.mean()) if len(costs) else 0.0,
+        "p99_us": float(np.percentile(costs, 99)) if len(costs) else 0.0,
+        "max_us": float(costs.max()) if len(costs) else 0.0,
+        "bytes_per_event": nBytes / nEvents if nEvents else 0.0,
+    }
+
+
+def CaseKey(result):
+    return (result["outputs"], result["events"], result["mode"], result["tempo_changes"])
+
+
+# Relative change of a result against the earlier run, n/a when the
+# earlier value is zero (e.g. a case too short to time)
+def Change(result, old, key):
+    if not old[key]:
+        return "%7s" % "n/a"
+    return "%+6.1f%%" % (100.0 * (result[key] / old[key] - 1))
+
+
+def Compare(results, baseline):
+    before = {CaseKey(result): result for result in baseline["results"]}
+    for result in results:
+        old = before.get(CaseKey(result))
+        if old is None:
+            continue
+        print("%-28s events/s %s  mean %s  p99 %s" % (
+            "%d out %d ev %s" % CaseKey(result)[:3],
+            Change(result, old, "events_per_sec"),
+            Change(result, old, "mean_us"),
+            Change(result, old, "p99_us")))
+
+
+def IntList(text):
+    return [int(float(value)) for value in text.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sync engine with synthetic loads")
+    parser.add_argument("--outputs", type=IntList, default=[1, 8, 64], help="comma separated output counts")
+    parser.add_argument("--events", type=IntList, default=[1000, 100000], help="comma separated queued event counts (1e6 allowed)")
+    parser.add_argument("--modes", default="S_INT,S_MIDI", help="comma separated sync modes")
+    parser.add_argument("--ticks", type=int, default=9600, help="song length in ticks")
+    parser.add_argument("--tempo-changes", type=int, default=8, help="tempo changes on the first output")
+    parser.add_argument("--timer-period", type=int, default=1, help="wTimerPeriod in ms")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    results = []
+    for mode in args.modes.split(","):
+        for nOutputs in args.outputs:
+            for nEvents in args.events:
+                result = RunCase(nOutputs, nEvents, args.ticks, mode, args.tempo_changes, args.timer_period, args.seed)
+                results.append(result)
+                print("%-6s %3d outputs %8d events: %10.0f events/s  mean %7.1f us  p99 %7.1f us  %5.1f bytes/event" % (
+                    mode, nOutputs, nEvents, result["events_per_sec"], result["mean_us"],
+                    result["p99_us"], result["bytes_per_event"]))
+
+    run = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "args": vars(args),
+    }
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            Compare(results, json.load(baseline_file))
+
+    if args.json:
+        with open(args.json, "w") as output_file:
+            json.dump({"run": run, "results": results}, output_file, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
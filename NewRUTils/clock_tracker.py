@@ -0,0 +1,123 @@
+from collections import deque
+
+
+#-----------------------------------------------------------------------------
+# MIDI clock tempo tracker
+#
+# Estimates the tempo of an external MIDI clock master for S_MIDI sync
+# from the arrival times of its clocks. A least squares line is fitted
+# through the last nWindow clock times (clock number against time); its
+# slope is the clock period, so the timing jitter of single clocks
+# averages out instead of moving the tempo on every clock. A larger
+# nWindow gives a steadier tempo, a smaller one follows tempo changes of
+# the master sooner. nWindow = 24 averages over one beat.
+#
+# sync() holds the song position to the clock count only within fSlack
+# of a clock: a clock arriving less than that early or late (jitter) no
+# longer forces a tick correction or a hold. MidiClock instead bends the
+# tempo to bring the position back onto the clock count over the next
+# nPull clocks; the fractional ticks are kept, so once the estimate is
+# right the bend returns to 1 with the position on the clock count.
+# fSlack = 0 locks the position to every clock as before.
+#
+# The tracker also measures:
+#
+#   jitter      RMS distance of the clock times from the fitted line, uS
+#   drift       rate of change of the estimated tempo, uS per beat per
+#               second (positive when the master slows down)
+#
+# A gap of more than MAX_GAP clock periods (the master stopped) starts
+# the estimate again.
+#-----------------------------------------------------------------------------
+
+MAX_GAP = 8
+
+
+class ClockTracker:
+    def __init__(self, nWindow=24, fSlack=0.25, nPull=None):
+        self.nWindow = max(2, nWindow)
+        self.fSlack = fSlack            # clocks
+        self.nPull = nPull if nPull else max(1, self.nWindow // 4)
+        self.Reset()
+
+    def Reset(self):
+        self.times = deque(maxlen=self.nWindow)     # clock arrival, nS
+        self.estimates = deque(maxlen=self.nWindow) # (nS, uS per beat)
+        self.uSPerBeat = None
+        self.fBend = 1.0
+        self.uSJitter = 0.0
+        self.drift = 0.0
+        self.nClocks = 0
+
+    #-------------------------------------------------------------------------
+    # Clock
+    # Adds a clock received at nsTime (monotonic nS) and returns the new
+    # tempo estimate in uS per beat, or None until two clocks have been
+    # seen.
+    #-------------------------------------------------------------------------
+    def Clock(self, nsTime):
+        times = self.times
+        if times and self.uSPerBeat is not None and \
+                nsTime - times[-1] > MAX_GAP * self.uSPerBeat * 1000 / 24:
+            self.Reset()
+            times = self.times
+
+        times.append(nsTime)
+        self.nClocks += 1
+        n = len(times)
+        if n < 2:
+            return None
+
+        # Fit t = t0 + slope * x over x = 0 .. n-1, relative to the first
+        # time so the sums stay small
+        t0 = times[0]
+        xMean = (n - 1) / 2.0
+        tMean = sum(times) / n - t0
+        sxx = n * (n * n - 1) / 12.0
+        sxt = 0.0
+        for x, t in enumerate(times):
+            sxt += (x - xMean) * (t - t0 - tMean)
+        nsPerClock = sxt / sxx
+
+        residual = 0.0
+        for x, t in enumerate(times):
+            error = t - t0 - tMean - nsPerClock * (x - xMean)
+            residual += error * error
+        self.uSJitter = (residual / n) ** 0.5 / 1000.0
+
+        self.uSPerBeat = nsPerClock * 24 / 1000.0
+        estimates = self.estimates
+        estimates.append((nsTime, self.uSPerBeat))
+        if len(estimates) > 1 and nsTime > estimates[0][0]:
+            self.drift = (self.uSPerBeat - estimates[0][1]) * 1e9 / (nsTime - estimates[0][0])
+        return self.uSPerBeat
+
+    #-------------------------------------------------------------------------
+    # Bend
+    # Returns the factor the estimated tempo is bent by to bring a
+    # position fBehind ticks behind the clock count (negative when ahead)
+    # back onto it over nPull clocks.
+    #-------------------------------------------------------------------------
+    def Bend(self, fBehind, nTicksPerClock):
+        self.fBend = 1.0 - fBehind / float(nTicksPerClock * self.nPull)
+        return self.fBend
+
+    #-------------------------------------------------------------------------
+    # Slack
+    # Returns the slack in ticks, none until there is a tempo estimate.
+    #-------------------------------------------------------------------------
+    def Slack(self, nTicksPerClock):
+        if self.uSPerBeat is None:
+            return 0
+        return int(self.fSlack * nTicksPerClock)
+
+    def Snapshot(self):
+        return {
+            "clocks": self.nClocks,
+            "window": self.nWindow,
+            "slack": self.fSlack,
+            "us_per_beat": self.uSPerBeat,
+            "bend": self.fBend,
+            "jitter_us": self.uSJitter,
+            "drift_us_per_beat_per_sec": self.drift,
+        }
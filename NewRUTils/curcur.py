@@ -1,11 +1,18 @@
 import multiprocessing
 
+import numpy as np
+
+from song_codec import encode_song, decode_song, record_size, song_hash_batch
+from song_index import SongSpace
+from song_transport import SongTransport
+
 
 if __name__ == '__main__':
     target = int(input("Enter Number of Songs to generate"))  # 20 billion unique songs
     num_producers = multiprocessing.cpu_count() - 1  # Use all but one core for producers
 
-    queue = multiprocessing.Queue(maxsize=1000)
+    # One shared memory ring per producer
+    transport = SongTransport(num_producers, record_size(4, 12))
 
     # Initialize FSM for each producer
     # Define FSM class
@@ -21,26 +28,34 @@ if __name__ == '__main__':
         # Placeholder for melody generation logic
         return generate_melody_state
 
-    # Define generate_unique_song function
-    def generate_unique_song(queue, fsm):
-        # Placeholder for unique song generation logic
-        queue.put("Unique Song")
+    # Songs numbered by index, with star.py's 7 chords and 4 durations
+    song_space = SongSpace(7, 4)
+
+    # Define generate_unique_song function: each producer sends the
+    # songs of its own index range, so no two producers repeat a song
+    def generate_unique_song(ring, fsm, start, stop):
+        for batch_start in range(start, stop, transport.batch_size):
+            batch = [encode_song(*song_space.song(index))
+                     for index in range(batch_start, min(batch_start + transport.batch_size, stop))]
+            records = np.frombuffer(b"".join(batch), dtype=np.uint8).reshape(len(batch), -1)
+            ring.put(records, song_hash_batch(records))
 
     # Define consumer function
-    def consumer(queue, target):
+    def consumer(transport, target):
         count = 0
         while count < target:
-            song = queue.get()
-            print(f"Consumed: {song}")
-            count += 1
+            records, _ = transport.get(target - count)
+            for record in records[:target - count]:
+                print(f"Consumed: {decode_song(record.tobytes())}")
+                count += 1
 
     fsms = [FSM(generate_melody_state) for _ in range(num_producers)]
 
     # Create producer processes
-    producers = [multiprocessing.Process(target=generate_unique_song, args=(queue, fsms[i])) for i in range(num_producers)]
+    producers = [multiprocessing.Process(target=generate_unique_song, args=(transport.writer(i), fsms[i], *SongSpace.worker_range(i, num_producers, target))) for i in range(num_producers)]
 
     # Create and start consumer process
-    consumer_process = multiprocessing.Process(target=consumer, args=(queue, target))
+    consumer_process = multiprocessing.Process(target=consumer, args=(transport, target))
     consumer_process.start()
 
     # Start producer processes
@@ -52,4 +67,5 @@ if __name__ == '__main__':
         producer.join()
 
     # Wait for consumer process to finish
-    consumer_process.join()
\ No newline at end of file
+    consumer_process.join()
+    transport.close()
\ No newline at end of file
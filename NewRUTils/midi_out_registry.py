@@ -0,0 +1,124 @@
+import numpy as np
+
+
+#-----------------------------------------------------------------------------
+# MIDI out registry
+#
+# Table of the MIDI outputs attached to a sync device, kept as
+# lpSync.lpMidiOutList. Outputs can be attached and detached at any time.
+# Each output owns a slot, and the per-output state the sync handler
+# checks on every tick lives in arrays indexed by slot:
+#
+#   dwFlags     copy of the output flags (SYNC_OUTPUT selects clock targets)
+#   dwNextDue   absolute tick of the output's next queued event, 0 when
+#               new events were pushed and it has to be looked at again,
+#               NEVER when its buffer is empty
+#
+# so on each tick sync() finds the outputs with something due with one
+# array comparison, and MIDI clock, start and stop go to a precomputed
+# list of outputs instead of a per-output flag test. Iterating the
+# registry yields the attached outputs in slot order.
+#-----------------------------------------------------------------------------
+
+NEVER = np.iinfo(np.int64).max
+
+
+class MidiOutRegistry:
+    def __init__(self, nSlots=16):
+        self.outputs = [None] * nSlots
+        self.dwFlags = np.zeros(nSlots, dtype=np.uint32)
+        self.dwNextDue = np.full(nSlots, NEVER, dtype=np.int64)
+        self.nSlots = 0                 # slots in use, including detached gaps
+        self.freeSlots = []
+        self.selected = {}              # dwFlag mask -> list of outputs
+
+    def __iter__(self):
+        return (lpMO for lpMO in self.outputs[:self.nSlots] if lpMO is not None)
+
+    def __len__(self):
+        return self.nSlots - len(self.freeSlots)
+
+    def Attach(self, lpMO):
+        if self.freeSlots:
+            nSlot = self.freeSlots.pop()
+        else:
+            if self.nSlots == len(self.outputs):
+                self._Grow()
+            nSlot = self.nSlots
+            self.nSlots += 1
+
+        lpMO.nSlot = nSlot
+        self.outputs[nSlot] = lpMO
+        self.dwFlags[nSlot] = lpMO.dwFlags
+        self.dwNextDue[nSlot] = 0
+
+        # Pushing into the output buffer flags the slot for the next tick
+        lpMO.lpMidiOutData.lpfnPushed = lambda: self.dwNextDue.__setitem__(nSlot, 0)
+
+        self.selected.clear()
+        return nSlot
+
+    def Detach(self, lpMO):
+        nSlot = lpMO.nSlot
+        if self.outputs[nSlot] is not lpMO:
+            return False
+
+        lpMO.lpMidiOutData.lpfnPushed = None
+        self.outputs[nSlot] = None
+        self.dwFlags[nSlot] = 0
+        self.dwNextDue[nSlot] = NEVER
+        self.freeSlots.append(nSlot)
+        self.selected.clear()
+        return True
+
+    def _Grow(self):
+        nSize = len(self.outputs) * 2
+        self.outputs.extend([None] * (nSize - len(self.outputs)))
+        self.dwFlags = np.concatenate((self.dwFlags, np.zeros(nSize - len(self.dwFlags), dtype=np.uint32)))
+        self.dwNextDue = np.concatenate((self.dwNextDue, np.full(nSize - len(self.dwNextDue), NEVER, dtype=np.int64)))
+
+    def SetFlags(self, lpMO, dwFlags):
+        lpMO.dwFlags = dwFlags
+        self.dwFlags[lpMO.nSlot] = dwFlags
+        self.selected.clear()
+
+    #-------------------------------------------------------------------------
+    # Outputs / Handles
+    # Return every output (or its hMidiOut) with any of dwMask set. The
+    # selection is cached until an output is attached, detached or has its
+    # flags changed.
+    #-------------------------------------------------------------------------
+    def Outputs(self, dwMask):
+        outputs = self.selected.get(dwMask)
+        if outputs is None:
+            nSlots = np.flatnonzero(self.dwFlags[:self.nSlots] & dwMask)
+            outputs = self.selected[dwMask] = [self.outputs[nSlot] for nSlot in nSlots.tolist()]
+        return outputs
+
+    def Handles(self, dwMask):
+        return [lpMO.hMidiOut for lpMO in self.Outputs(dwMask)]
+
+    #-------------------------------------------------------------------------
+    # DueOutputs
+    # Returns the outputs that may have an event due at or before dwTicks.
+    #-------------------------------------------------------------------------
+    def DueOutputs(self, dwTicks):
+        nSlots = np.flatnonzero(self.dwNextDue[:self.nSlots] <= dwTicks)
+        return [self.outputs[nSlot] for nSlot in nSlots.tolist()]
+
+    #-------------------------------------------------------------------------
+    # UpdateDue
+    # Recomputes the next due tick of lpMO from the head of its buffer.
+    # The slot is cleared first, so an event pushed meanwhile either shows
+    # in the span read here or sets the slot back to 0 afterwards.
+    #-------------------------------------------------------------------------
+    def UpdateDue(self, lpMO):
+        nSlot = lpMO.nSlot
+        lpRing = lpMO.lpMidiOutData
+        self.dwNextDue[nSlot] = NEVER
+        if lpRing.Span() != 0:
+            self.dwNextDue[nSlot] = min(self.dwNextDue[nSlot],
+                                        lpMO.dwLastEventTicks + int(lpRing.events["time"][lpRing.nOut % lpRing.nSize]))
+
+    def AllEmpty(self):
+        return not (self.dwNextDue[:self.nSlots] != NEVER).any()
@@ -0,0 +1,236 @@
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import itertools
+import logging
+import threading
+import time
+from ctypes import Structure, c_long, byref
+
+
+#-----------------------------------------------------------------------------
+# High resolution timer backend
+#
+# Replaces the Windows multimedia timer behind timeSetEvent/timeKillEvent.
+# All timers are serviced by one shared thread, however many sync devices
+# are open. Every deadline is computed as start + n * period on the
+# monotonic nanosecond clock and kept in a heap, and the thread sleeps
+# until the earliest absolute deadline, so sleep overshoot never
+# accumulates into drift and each timer keeps its own period.
+#
+# The thread waits on a condition until shortly before the deadline, so
+# setting a timer with an earlier deadline wakes it, and sleeps the last
+# SPIN_NS on the clock itself: on Linux with clock_nanosleep(
+# CLOCK_MONOTONIC, TIMER_ABSTIME), which wakes at the deadline itself,
+# elsewhere for the remaining time to the deadline.
+#
+# A periodic timer that fires late runs the callback once for every period
+# it missed, so code that advances time by one period per call (sync())
+# stays in step with the wall clock. If it falls more than MAX_CATCHUP
+# periods behind, the missed periods are dropped and the deadlines are
+# re-anchored to now. Catch-up calls stay in deadline order with the other
+# timers, so one late device does not hold the rest back further.
+#
+# The callback is called as callback(wTimerID, 0, dwUser, dw1, dw2) with
+# dw1 the deadline and dw2 the time the callback actually ran, both in
+# monotonic nanoseconds. A callback that raises is logged and the
+# service carries on with the other timers; should the thread die anyway,
+# GetService starts a new one that takes over the timers.
+#-----------------------------------------------------------------------------
+
+TIME_ONESHOT = 0
+TIME_PERIODIC = 1
+
+MAX_CATCHUP = 100
+
+# Final stretch before a deadline slept on the clock, not the condition
+SPIN_NS = 2000000
+
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+
+logger = logging.getLogger(__name__)
+
+
+class timespec(Structure):
+    _fields_ = [("tv_sec", c_long),
+                ("tv_nsec", c_long)]
+
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    clock_nanosleep = libc.clock_nanosleep
+except (OSError, AttributeError, TypeError):
+    clock_nanosleep = None
+
+
+def SleepUntil(deadline_ns):
+    if clock_nanosleep is not None:
+        ts = timespec(deadline_ns // 1000000000, deadline_ns % 1000000000)
+        # Restarted if interrupted by a signal; the deadline does not move
+        while clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, byref(ts), None) == errno.EINTR:
+            pass
+    else:
+        remaining = deadline_ns - time.monotonic_ns()
+        if remaining > 0:
+            time.sleep(remaining / 1000000000)
+
+
+def GetPeriodMin():
+    # Smallest period in whole ms that the monotonic clock can resolve
+    resolution_ms = time.get_clock_info("monotonic").resolution * 1000
+    return max(1, int(resolution_ms + 0.999999))
+
+
+class Timer:
+    __slots__ = ("wTimerID", "period_ns", "callback", "dwUser", "flags", "deadline", "bKilled")
+
+    def __init__(self, wTimerID, wPeriod, callback, dwUser, flags):
+        self.wTimerID = wTimerID
+        self.period_ns = wPeriod * 1000000
+        self.callback = callback
+        self.dwUser = dwUser
+        self.flags = flags
+        self.deadline = time.monotonic_ns() + self.period_ns
+        self.bKilled = False
+
+
+class TimerService(threading.Thread):
+    def __init__(self):
+        super().__init__(name="mmtimer", daemon=True)
+        self.cv = threading.Condition()
+        self.heap = []                  # (deadline, wTimerID)
+        self.timers = {}                # wTimerID -> Timer
+        self.running = ()               # ids of the timers in the batch being run
+
+    def Add(self, timer):
+        with self.cv:
+            self.timers[timer.wTimerID] = timer
+            heapq.heappush(self.heap, (timer.deadline, timer.wTimerID))
+            self.cv.notify()
+
+    #-------------------------------------------------------------------------
+    # Remove
+    # Once Remove returns, the callback of the timer will not run again.
+    # If it is running on the service thread it is waited for, unless the
+    # callback is removing its own timer.
+    #-------------------------------------------------------------------------
+    def Remove(self, wTimerID):
+        with self.cv:
+            timer = self.timers.pop(wTimerID, None)
+            if timer is None:
+                return False
+            timer.bKilled = True
+            if threading.current_thread() is not self:
+                while wTimerID in self.running:
+                    self.cv.wait()
+            return True
+
+    #-------------------------------------------------------------------------
+    # TakeDue
+    # Removes every deadline reached by now from the heap, scheduling the
+    # next deadline of each periodic timer, and returns them in deadline
+    # order as (timer, deadline). Called with the condition held.
+    #-------------------------------------------------------------------------
+    def TakeDue(self):
+        heap = self.heap
+        now = time.monotonic_ns()
+        due = []
+        while heap and heap[0][0] <= now:
+            deadline, wTimerID = heapq.heappop(heap)
+            timer = self.timers.get(wTimerID)
+            if timer is None:
+                continue
+
+            missed = (now - deadline) // timer.period_ns
+            if missed > MAX_CATCHUP:
+                # Too far behind to catch up, start again from now
+                deadline += missed * timer.period_ns
+
+            if timer.flags == TIME_ONESHOT:
+                del self.timers[wTimerID]
+            else:
+                # A missed period comes round again in this batch
+                timer.deadline = deadline + timer.period_ns
+                heapq.heappush(heap, (timer.deadline, wTimerID))
+            due.append((timer, deadline))
+        return due
+
+    def run(self):
+        heap = self.heap
+        while True:
+            with self.cv:
+                # Entries of removed timers are dropped as they come up
+                while heap and heap[0][1] not in self.timers:
+                    heapq.heappop(heap)
+                if not heap:
+                    self.cv.wait()
+                    continue
+
+                deadline = heap[0][0]
+                remaining = deadline - time.monotonic_ns()
+                if remaining > SPIN_NS:
+                    self.cv.wait((remaining - SPIN_NS) / 1000000000)
+                    continue
+
+            if remaining > 0:
+                SleepUntil(deadline)
+
+            with self.cv:
+                due = self.TakeDue()
+                self.running = {timer.wTimerID for timer, _ in due}
+
+            try:
+                for timer, deadline in due:
+                    # A callback earlier in the batch may have killed it
+                    if timer.bKilled or timer.callback is None:
+                        continue
+                    try:
+                        timer.callback(timer.wTimerID, 0, timer.dwUser, deadline, time.monotonic_ns())
+                    except Exception:
+                        # One device's failure must not stop the others' timers
+                        logger.exception("Callback of timer %d failed", timer.wTimerID)
+            finally:
+                with self.cv:
+                    self.running = ()
+                    self.cv.notify_all()
+
+
+nTimerID = itertools.count(1)
+service = None
+service_lock = threading.Lock()
+
+
+def GetService():
+    global service
+    with service_lock:
+        if service is None or not service.is_alive():
+            old = service
+            service = TimerService()
+            if old is not None:
+                # The thread died: the new one takes over its timers
+                logger.error("Timer service thread died, restarting it")
+                with old.cv:
+                    service.timers = old.timers
+                    service.heap = [(timer.deadline, wTimerID) for wTimerID, timer in old.timers.items()]
+                    heapq.heapify(service.heap)
+            service.start()
+        return service
+
+
+def SetTimer(wPeriod, callback, dwUser, flags):
+    if wPeriod < GetPeriodMin():
+        return None
+
+    timer = Timer(next(nTimerID), wPeriod, callback, dwUser, flags)
+    GetService().Add(timer)
+    return timer.wTimerID
+
+
+def KillTimer(wTimerID):
+    return GetService().Remove(wTimerID)
+
+
+def NumTimers():
+    return len(GetService().timers)
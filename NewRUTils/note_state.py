@@ -0,0 +1,58 @@
+#-----------------------------------------------------------------------------
+# Note state
+#
+# Tracks the notes sounding on one MIDI output as a 16 channel x 128 note
+# bit array, one 128-bit integer per channel. TrackMidiOut sets or clears
+# one bit per note on / note off sent, and TurnNotesOff builds note offs
+# only for the bits still set, as a single running status byte string
+# that goes to the port in one write.
+#-----------------------------------------------------------------------------
+
+class NoteState:
+    __slots__ = ("channels",)
+
+    def __init__(self):
+        self.channels = [0] * 16
+
+    #-------------------------------------------------------------------------
+    # Track
+    # Updates the state for a short message packed as status | data1 << 8
+    # | data2 << 16. All Sound Off and All Notes Off clear the channel.
+    #-------------------------------------------------------------------------
+    def Track(self, dwMsg):
+        status = dwMsg & 0xF0
+        if status == 0x90:
+            nChannel = dwMsg & 0x0F
+            if dwMsg & 0x7F0000:
+                self.channels[nChannel] |= 1 << ((dwMsg >> 8) & 0x7F)
+            else:
+                self.channels[nChannel] &= ~(1 << ((dwMsg >> 8) & 0x7F))
+        elif status == 0x80:
+            self.channels[dwMsg & 0x0F] &= ~(1 << ((dwMsg >> 8) & 0x7F))
+        elif status == 0xB0 and ((dwMsg >> 8) & 0x7F) in (120, 123):
+            self.channels[dwMsg & 0x0F] = 0
+
+    def IsSounding(self, nChannel, nNote):
+        return bool((self.channels[nChannel] >> nNote) & 1)
+
+    def NumSounding(self):
+        return sum(bin(notes).count("1") for notes in self.channels)
+
+    #-------------------------------------------------------------------------
+    # NotesOff
+    # Returns the note offs for every sounding note, one 0x8n status byte
+    # per channel followed by note/velocity pairs, and clears the state.
+    # Returns an empty string if nothing is sounding.
+    #-------------------------------------------------------------------------
+    def NotesOff(self):
+        data = bytearray()
+        for nChannel, notes in enumerate(self.channels):
+            if not notes:
+                continue
+            data.append(0x80 | nChannel)
+            while notes:
+                low = notes & -notes
+                data += bytes(((low.bit_length() - 1), 0))
+                notes ^= low
+            self.channels[nChannel] = 0
+        return bytes(data)
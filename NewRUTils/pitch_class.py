@@ -0,0 +1,37 @@
+import numpy as np
+
+
+#////////////////////////////////////////////////////////////////////////
+#///////////////////// PITCH CLASS //////////////////////////////////////
+#////////////////////////////////////////////////////////////////////////
+
+# Twelve-tone transformations on pitch classes 0-11 (C = 0) held in int8
+# arrays, by lookup in static tables:
+#
+#   TRANSPOSE[n][pc]    Tn: pc + n mod 12
+#   INVERT[n][pc]       In: n - pc mod 12 (I0 mirrors around C, I11 maps
+#                       0..11 to 11..0)
+#
+# transpose and invert take a row (12,) or a batch of rows (rows, 12),
+# with one n for all rows or one per row, and transform every row with a
+# single fancy-indexing lookup. retrograde returns a reversed view.
+
+PITCH_CLASSES = np.arange(12, dtype=np.int8)
+TRANSPOSE = ((PITCH_CLASSES[:, None] + PITCH_CLASSES[None, :]) % 12).astype(np.int8)
+INVERT = ((PITCH_CLASSES[:, None] - PITCH_CLASSES[None, :]) % 12).astype(np.int8)
+TRANSPOSE.flags.writeable = False
+INVERT.flags.writeable = False
+
+
+# n as an index that broadcasts against the last axis of pcs
+def _rows(n):
+    return np.expand_dims(np.asarray(n) % 12, -1)
+
+def transpose(pcs, n):
+    return TRANSPOSE[_rows(n), pcs]
+
+def invert(pcs, n=0):
+    return INVERT[_rows(n), pcs]
+
+def retrograde(pcs):
+    return np.asarray(pcs)[..., ::-1]
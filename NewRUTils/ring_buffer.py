@@ -0,0 +1,137 @@
+import numpy as np
+from collections import namedtuple
+
+
+#-----------------------------------------------------------------------------
+# MIDI event ring buffer
+#
+# Preallocated ring of MIDI events for one producer and one consumer, used
+# for the MIDI out queues read by sync() and the MIDI in queue written by
+# SetTempo16. Events are stored in a NumPy structured array so whole
+# batches can be pushed and popped with at most two slice copies.
+#
+# The producer only ever advances nIn and the consumer only ever advances
+# nOut. Both are running totals, so the ring needs no lock: each side reads
+# the other's counter and writes only its own, after the data is in place.
+#
+# time is the delta time in ticks from the previous event, status is the
+# MIDI status byte (0 for a tempo event, 0xF0 for SYSEX).
+#-----------------------------------------------------------------------------
+
+MIDI_EVENT = np.dtype([("time", np.uint32),
+                       ("status", np.uint8),
+                       ("data1", np.uint8),
+                       ("data2", np.uint8),
+                       ("data3", np.uint8)])
+
+# One event as handed to SendMidiOutEvent
+MidiEvent = namedtuple("MidiEvent", ["time", "status", "data1", "data2", "data3"])
+
+
+class MidiEventRing:
+    def __init__(self, nSize, lpfnReady=None):
+        self.events = np.zeros(nSize, dtype=MIDI_EVENT)
+        self.nSize = nSize
+        self.nLowWater = nSize >> 2
+        self.nIn = 0            # events pushed, written by the producer only
+        self.nOut = 0           # events popped, written by the consumer only
+        self.nOverflows = 0     # events dropped because the ring was full
+        self.lpfnReady = lpfnReady  # called when the ring drains to 25% full
+        self.lpfnPushed = None      # called after events are pushed
+
+    def Span(self):
+        return self.nIn - self.nOut
+
+    def Free(self):
+        return self.nSize - (self.nIn - self.nOut)
+
+    #-------------------------------------------------------------------------
+    # Push
+    # Appends a batch of events (a MIDI_EVENT array or a list of tuples).
+    # Events that do not fit are dropped and counted in nOverflows. Returns
+    # the number of events stored.
+    #-------------------------------------------------------------------------
+    def Push(self, events):
+        events = np.asarray(events, dtype=MIDI_EVENT)
+        nFree = self.nSize - (self.nIn - self.nOut)
+        n = len(events)
+        if n > nFree:
+            self.nOverflows += n - nFree
+            n = nFree
+        if n == 0:
+            return 0
+
+        pIn = self.nIn % self.nSize
+        nFirst = min(n, self.nSize - pIn)
+        self.events[pIn:pIn + nFirst] = events[:nFirst]
+        self.events[:n - nFirst] = events[nFirst:n]
+
+        self.nIn += n
+        if self.lpfnPushed is not None:
+            self.lpfnPushed()
+        return n
+
+    def PushEvent(self, time, status, data1, data2=0, data3=0):
+        if self.nIn - self.nOut == self.nSize:
+            self.nOverflows += 1
+            return 0
+        self.events[self.nIn % self.nSize] = (time, status, data1, data2, data3)
+        self.nIn += 1
+        if self.lpfnPushed is not None:
+            self.lpfnPushed()
+        return 1
+
+    #-------------------------------------------------------------------------
+    # Peek
+    # Returns a copy of up to n queued events (all of them if n is None)
+    # without removing them.
+    #-------------------------------------------------------------------------
+    def Peek(self, n=None):
+        nSpan = self.nIn - self.nOut
+        if n is None or n > nSpan:
+            n = nSpan
+
+        pOut = self.nOut % self.nSize
+        nFirst = min(n, self.nSize - pOut)
+        if nFirst == n:
+            return self.events[pOut:pOut + n].copy()
+        return np.concatenate((self.events[pOut:], self.events[:n - nFirst]))
+
+    #-------------------------------------------------------------------------
+    # PeekDue
+    # Returns the queued events whose accumulated delta times fit within
+    # dwElapsed ticks, i.e. every event due now. Most calls find nothing
+    # due, which is answered from the first event without copying.
+    #-------------------------------------------------------------------------
+    def PeekDue(self, dwElapsed, nChunk=64):
+        nSpan = self.nIn - self.nOut
+        if nSpan == 0 or self.events["time"][self.nOut % self.nSize] > dwElapsed:
+            return self.events[:0]
+
+        nPeek = min(nChunk, nSpan)
+        while True:
+            events = self.Peek(nPeek)
+            nDue = np.searchsorted(np.cumsum(events["time"], dtype=np.uint64), dwElapsed, side="right")
+            if nDue < nPeek or nPeek == nSpan:
+                return events[:nDue]
+            nPeek = min(nPeek * 4, nSpan)
+
+    #-------------------------------------------------------------------------
+    # Drop
+    # Removes n events, signalling lpfnReady if the ring drains past the
+    # 25% full mark.
+    #-------------------------------------------------------------------------
+    def Drop(self, n):
+        nBefore = self.nIn - self.nOut
+        if n > nBefore:
+            n = nBefore
+        self.nOut += n
+
+        if self.lpfnReady is not None and nBefore >= self.nLowWater > nBefore - n:
+            self.lpfnReady()
+        return n
+
+    def Pop(self, n=None):
+        events = self.Peek(n)
+        self.Drop(len(events))
+        return events
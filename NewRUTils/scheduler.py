@@ -0,0 +1,317 @@
+import heapq
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from ring_buffer import MidiEvent
+from sysex_pool import SENDING_SYSEX
+from sync import (MXMIDIERR_MAXERR, SCALE, SYNC_RUNNING, SENT_SYNCDONE, SYNC_OUTPUT,
+                  ReadMidiOutEvents, SendMidiOutEvent, FlushMidiOut, PostMessage,
+                  TIME_PERIODIC, syncTimer, timeSetEvent, timeKillEvent)
+
+
+#-----------------------------------------------------------------------------
+# Lookahead event scheduler
+#
+# In scheduler mode the periodic sync timer is not used. Events are taken
+# out of the output buffers as soon as they are queued, converted once to
+# an absolute tick and millisecond position using the current tempo and
+# kept in a min-heap ordered by due time. The scheduler thread sleeps until
+# the next event, beat or MIDI clock is due, so idle outputs cost nothing
+# between events. Clock deadlines are only kept while some output has
+# SYNC_OUTPUT set.
+#
+# The output stream is the same as sync() would send: at the same tick
+# MIDI clocks go ahead of events, and the short messages of an output
+# sending SysEx are held back (with everything after them on that output)
+# until the SysEx is out.
+#
+# A tempo change (from a tempo event or SetTempo16) re-times the pending
+# events from their absolute tick positions. Scheduler mode only applies
+# to internal sync; in S_MIDI mode the external clock drives sync().
+#-----------------------------------------------------------------------------
+
+class EventScheduler:
+    def __init__(self, lpSync):
+        self.lpSync = lpSync
+        self.heap = []              # (msDue, nSeq, dwTicks, lpMO, event)
+        self.nSeq = 0
+        self.outputs = {}           # id(lpMO) -> lpMO
+        self.dwLoadedTicks = {}     # id(lpMO) -> absolute ticks of the last loaded event
+        self.held = {}              # lpMO -> deque of (dwTicks, event) held back by SysEx
+        self.cv = threading.Condition()
+        self.thread = None
+        self.bStop = False
+        self.Reset()
+
+    #-------------------------------------------------------------------------
+    # Reset
+    # Anchors the tick/ms conversion at the start of the song. Called by
+    # StartSync16 after it clears the tick count.
+    #-------------------------------------------------------------------------
+    def Reset(self):
+        with self.cv:
+            lpSync = self.lpSync
+            self.msBase = lpSync.msPosition
+            self.dwTicksBase = lpSync.dwTicks
+            self.dwNextBeat = lpSync.dwTicks + lpSync.wResolution
+            self.dwNextClock = lpSync.dwTicks + lpSync.nTicksPerClock
+            self.msClock = None
+            self.dwLoadedTicks.clear()
+            self._Reheap()
+
+    def TicksToMs(self, dwTicks):
+        lpSync = self.lpSync
+        return self.msBase + (dwTicks - self.dwTicksBase) * lpSync.dwTempo / (lpSync.wResolution * 1000.0 * SCALE)
+
+    def MsToTicks(self, ms):
+        lpSync = self.lpSync
+        return self.dwTicksBase + int((ms - self.msBase) * lpSync.wResolution * 1000 * SCALE // lpSync.dwTempo)
+
+    #-------------------------------------------------------------------------
+    # Load
+    # Moves everything queued in the output buffer of lpMO into the heap.
+    # Call after filling the buffer (for example on OUTBUFFER_READY).
+    #-------------------------------------------------------------------------
+    def Load(self, lpMO):
+        with self.cv:
+            self.outputs[id(lpMO)] = lpMO
+            dwTicks = self.dwLoadedTicks.get(id(lpMO), lpMO.dwLastEventTicks)
+
+            # Convert the whole batch of delta times to absolute ticks at once
+            events = ReadMidiOutEvents(lpMO)
+            dwEventTicks = dwTicks + np.cumsum(events["time"], dtype=np.int64)
+            for (_, status, data1, data2, data3), dwTicks in zip(events.tolist(), dwEventTicks.tolist()):
+                event = MidiEvent(dwTicks, status, data1, data2, data3)
+                heapq.heappush(self.heap, (self.TicksToMs(dwTicks), self.nSeq, dwTicks, lpMO, event))
+                self.nSeq += 1
+            self.dwLoadedTicks[id(lpMO)] = dwTicks
+            self.cv.notify()
+
+    #-------------------------------------------------------------------------
+    # Retime
+    # Re-anchors the conversion at the current position and recomputes the
+    # due time of every pending event after a tempo change.
+    #-------------------------------------------------------------------------
+    def Retime(self, dwTicks=None, ms=None):
+        with self.cv:
+            if dwTicks is None:
+                dwTicks = self.lpSync.dwTicks
+                ms = self.lpSync.msPosition
+            self.dwTicksBase = dwTicks
+            self.msBase = ms
+            self._Reheap()
+            self.cv.notify()
+
+    def _Reheap(self):
+        self.heap[:] = [(self.TicksToMs(entry[2]),) + entry[1:] for entry in self.heap]
+        heapq.heapify(self.heap)
+
+    def Wake(self):
+        with self.cv:
+            self.cv.notify()
+
+    # Ends the scheduler thread and waits for it
+    def Stop(self):
+        with self.cv:
+            self.bStop = True
+            self.cv.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    #-------------------------------------------------------------------------
+    # NextDue
+    # Returns the song position in ms of the next event, beat or clock.
+    #-------------------------------------------------------------------------
+    def NextDue(self):
+        dwTicks = self.dwNextBeat
+        if self.SendsClocks():
+            dwTicks = min(dwTicks, self.dwNextClock)
+        msDue = self.TicksToMs(dwTicks)
+        if self.heap and self.heap[0][0] < msDue:
+            msDue = self.heap[0][0]
+
+        # SysEx in progress goes out one chunk per timer period, and the
+        # events held back by it go the period after it is done
+        if self.lpSync.lpSysexPool.IsSending() or self.held:
+            msDue = min(msDue, self.lpSync.msPosition + self.lpSync.wTimerPeriod)
+        return msDue
+
+    def SendsClocks(self):
+        lpSync = self.lpSync
+        return lpSync.wSyncMode != "S_MIDI" and bool(lpSync.lpMidiOutList.Outputs(SYNC_OUTPUT))
+
+    #-------------------------------------------------------------------------
+    # Send
+    # Sends an event of lpMO, or holds it back as sync() would: behind a
+    # SysEx being sent, unless it is a SysEx itself, or behind events of
+    # lpMO already held back.
+    #-------------------------------------------------------------------------
+    def Send(self, lpMO, dwTicks, event):
+        held = self.held.get(lpMO)
+        if held is None and (lpMO.dwFlags & SENDING_SYSEX) and event.status != 0xF0:  # 0xF0 is SYSEX
+            held = self.held[lpMO] = deque()
+        if held is not None:
+            held.append((dwTicks, event))
+            return
+
+        lpSync = self.lpSync
+        lpMO.dwLastEventTicks = dwTicks
+        SendMidiOutEvent(lpSync, lpMO, event)
+
+    #-------------------------------------------------------------------------
+    # Release
+    # Sends the held back events of outputs whose SysEx is out, up to the
+    # next short message held back by a SysEx sent meanwhile.
+    #-------------------------------------------------------------------------
+    def Release(self):
+        lpSync = self.lpSync
+        dwTempo = lpSync.dwTempo
+        for lpMO in list(self.held):
+            held = self.held[lpMO]
+            while held and not ((lpMO.dwFlags & SENDING_SYSEX) and held[0][1].status != 0xF0):
+                dwTicks, event = held.popleft()
+                lpMO.dwLastEventTicks = dwTicks
+                SendMidiOutEvent(lpSync, lpMO, event)
+            if not held:
+                del self.held[lpMO]
+
+        # A tempo event held back takes effect from now
+        if lpSync.dwTempo != dwTempo:
+            self.Retime()
+
+    #-------------------------------------------------------------------------
+    # Dispatch
+    # Sends everything due at or before song position msNow, in time order,
+    # and advances the sync position to msNow.
+    #-------------------------------------------------------------------------
+    def Dispatch(self, msNow):
+        lpSync = self.lpSync
+        heap = self.heap
+        bClocks = self.SendsClocks()
+
+        if self.held:
+            self.Release()
+
+        # At the same time beats go first, then clocks, then events, as in
+        # sync()
+        while True:
+            msBeat = self.TicksToMs(self.dwNextBeat)
+            msClock = self.TicksToMs(self.dwNextClock) if bClocks else float("inf")
+            msEvent = heap[0][0] if heap else float("inf")
+            msNext = min(msEvent, msNow)
+
+            if msBeat <= msNext and msBeat <= msClock:
+                PostMessage(lpSync.hWnd, "MIDI_BEAT", 0, lpSync)
+                self.dwNextBeat += lpSync.wResolution
+            elif msClock <= msNext:
+                for lpClockMO in lpSync.lpMidiOutList.Outputs(SYNC_OUTPUT):
+                    lpClockMO.lpEncoder.AddRealTime(b"\xf8")  # 0xF8 is MIDI_CLOCK
+                self.dwNextClock += lpSync.nTicksPerClock
+            elif msEvent <= msNow:
+                msDue, _, dwTicks, lpMO, event = heapq.heappop(heap)
+                lpSync.dwTicks = max(lpSync.dwTicks, dwTicks)
+                dwTempo = lpSync.dwTempo
+                self.Send(lpMO, dwTicks, event)
+                if lpSync.dwTempo != dwTempo:
+                    self.Retime(dwTicks, msDue)
+            else:
+                break
+
+        lpSync.dwTicks = max(lpSync.dwTicks, self.MsToTicks(msNow))
+        lpSync.msPosition = int(msNow)
+
+        # Without clock outputs the clock deadline just keeps its phase
+        if not bClocks and self.dwNextClock <= lpSync.dwTicks:
+            nTicksPerClock = lpSync.nTicksPerClock
+            self.dwNextClock += ((lpSync.dwTicks - self.dwNextClock) // nTicksPerClock + 1) * nTicksPerClock
+
+        # One write per output for everything sent by this call
+        for lpMO in lpSync.lpMidiOutList:
+            FlushMidiOut(lpMO)
+
+        if lpSync.lpSysexPool.IsSending():
+            lpSync.lpSysexPool.Pump(lpSync)
+
+        if not heap and not self.held and (lpSync.nSysexBuffsActive == 0) and ((lpSync.wFlags & SENT_SYNCDONE) == 0):
+            PostMessage(lpSync.hWnd, "SYNC_DONE", 0, lpSync)
+            lpSync.wFlags |= SENT_SYNCDONE
+
+    #-------------------------------------------------------------------------
+    # Run
+    # Scheduler thread. Waits while sync is not running, otherwise sleeps
+    # until the next due time or until woken by Load, Retime or Wake.
+    #-------------------------------------------------------------------------
+    def Run(self):
+        lpSync = self.lpSync
+        with self.cv:
+            while not self.bStop:
+                if (lpSync.wFlags & SYNC_RUNNING) != SYNC_RUNNING:
+                    self.msClock = None
+                    self.cv.wait()
+                    continue
+
+                if self.msClock is None:
+                    self.msClock = time.monotonic() * 1000.0 - lpSync.msPosition
+
+                self.Dispatch(time.monotonic() * 1000.0 - self.msClock)
+
+                msWait = self.NextDue() - (time.monotonic() * 1000.0 - self.msClock)
+                if msWait > 0:
+                    self.cv.wait(msWait / 1000.0)
+
+
+#-----------------------------------------------------------------------------
+# OpenScheduler16
+#
+# Switches an opened sync device to scheduler mode. The periodic timer is
+# released and a scheduler thread takes over dispatching; reopening the
+# device keeps it in scheduler mode and CloseSync16 stops the thread.
+# Block mode can not be set meanwhile. Returns the
+# scheduler, whose Load() method must be called for each output after its
+# buffer has been filled.
+#-----------------------------------------------------------------------------
+def OpenScheduler16(hSync):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return None
+
+    lpSync = hSync
+    if lpSync.lpScheduler is not None:
+        return lpSync.lpScheduler
+
+    # The scheduler replaces the periodic timer
+    if lpSync.wTimerID is not None:
+        timeKillEvent(lpSync.wTimerID)
+        lpSync.wTimerID = None
+
+    lpScheduler = EventScheduler(lpSync)
+    lpSync.lpScheduler = lpScheduler
+    lpScheduler.thread = threading.Thread(target=lpScheduler.Run, daemon=True)
+    lpScheduler.thread.start()
+    return lpScheduler
+
+
+#-----------------------------------------------------------------------------
+# CloseScheduler16
+#
+# Stops the scheduler thread and returns the sync device to per-interrupt
+# polling. Events still in the heap are discarded.
+#-----------------------------------------------------------------------------
+def CloseScheduler16(hSync):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return
+
+    lpSync = hSync
+    lpScheduler = lpSync.lpScheduler
+    if lpScheduler is None:
+        return
+
+    lpScheduler.Stop()
+    lpSync.lpScheduler = None
+
+    # Restart the periodic timer
+    lpSync.wTimerID = timeSetEvent(lpSync.wTimerPeriod, lpSync.wTimerPeriod, syncTimer, lpSync, TIME_PERIODIC)
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+#////////////////////////////////////////////////////////////////////////
+#///////////////////// SONG RECORD //////////////////////////////////////
+#////////////////////////////////////////////////////////////////////////
+
+# A generated song is fully described by its tone row, the transformation
+# applied to it and the chord and rhythm choices, so that is all that is
+# encoded. The twelve-tone matrix, the melody and the note names are
+# rebuilt from the record when needed.
+#
+# Record layout (one byte each, 31 bytes for 4 chords and 12 durations):
+#
+#   row          12 pitch classes 0-11
+#   transform    TRANSFORM_* id
+#   n_chords     followed by n_chords chord ids
+#   n_rhythm     followed by n_rhythm duration ids
+#
+# The encoding is canonical: equal songs always give equal bytes, so the
+# 64-bit hash of the record identifies the song.
+
+TRANSFORM_PRIME = 0
+TRANSFORM_TRANSPOSE = 1     # transposed up 2 semitones
+TRANSFORM_INVERT = 2
+TRANSFORM_RETROGRADE = 3
+
+
+def record_size(n_chords, n_rhythm):
+    return 15 + n_chords + n_rhythm
+
+
+def encode_song(row, transform, chord_ids, rhythm_ids):
+    return bytes([*row, transform, len(chord_ids), *chord_ids, len(rhythm_ids), *rhythm_ids])
+
+
+def decode_song(record):
+    row = list(record[:12])
+    transform = record[12]
+    n_chords = record[13]
+    chord_ids = list(record[14:14 + n_chords])
+    n_rhythm = record[14 + n_chords]
+    rhythm_ids = list(record[15 + n_chords:15 + n_chords + n_rhythm])
+    return row, transform, chord_ids, rhythm_ids
+
+
+# Records of a batch of songs as one (n, record length) uint8 array, row
+# i equal to encode_song of song i. rows (n, 12), transforms (n,),
+# chord_ids (n, n_chords), rhythm_ids (n, n_rhythm)
+def encode_song_batch(rows, transforms, chord_ids, rhythm_ids):
+    n, n_chords = chord_ids.shape
+    n_rhythm = rhythm_ids.shape[1]
+    records = np.empty((n, record_size(n_chords, n_rhythm)), dtype=np.uint8)
+    records[:, :12] = rows
+    records[:, 12] = transforms
+    records[:, 13] = n_chords
+    records[:, 14:14 + n_chords] = chord_ids
+    records[:, 14 + n_chords] = n_rhythm
+    records[:, 15 + n_chords:] = rhythm_ids
+    return records
+
+
+# 64-bit hash of a record, stable across runs and processes (unlike
+# hash()). The record is zero padded to whole little-endian 64-bit words
+# and each word is xored into the state followed by the splitmix64
+# finalizer, starting from a state seeded with the record length. Every
+# step is a bijection of the state, so records differing in one word
+# never collide. song_hash_batch hashes every row of a records array at
+# once, one numpy pass per word; song_hash of a record gives the same
+# value. HASH_NAME is written into stores and sinks keyed by these
+# hashes, which refuse to open under a different one.
+HASH_NAME = "mix64-v1"
+HASH_SEED = 0x9E3779B97F4A7C15
+
+_MIX_SHIFTS = (np.uint64(30), np.uint64(27), np.uint64(31))
+_MIX_MULTS = (np.uint64(0xBF58476D1CE4E5B9), np.uint64(0x94D049BB133111EB))
+
+
+def _mix64(h):
+    h ^= h >> _MIX_SHIFTS[0]
+    h *= _MIX_MULTS[0]
+    h ^= h >> _MIX_SHIFTS[1]
+    h *= _MIX_MULTS[1]
+    h ^= h >> _MIX_SHIFTS[2]
+    return h
+
+
+def song_hash_batch(records):
+    records = np.asarray(records, dtype=np.uint8)
+    n, size = records.shape
+    n_words = (size + 7) // 8
+    padded = np.zeros((n, n_words * 8), dtype=np.uint8)
+    padded[:, :size] = records
+    words = padded.view("<u8").astype(np.uint64, copy=False)
+
+    hashes = np.full(n, (HASH_SEED + size) & 0xFFFFFFFFFFFFFFFF, dtype=np.uint64)
+    for word in range(n_words):
+        hashes ^= words[:, word]
+        _mix64(hashes)
+    return hashes
+
+
+def song_hash(record):
+    return int(song_hash_batch(np.frombuffer(bytes(record), dtype=np.uint8)[None])[0])
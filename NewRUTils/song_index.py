@@ -0,0 +1,132 @@
+from math import factorial
+
+
+#////////////////////////////////////////////////////////////////////////
+#///////////////////// SONG INDEX ///////////////////////////////////////
+#////////////////////////////////////////////////////////////////////////
+
+# Numbers every possible song, so songs can be enumerated instead of
+# drawn at random and deduplicated. A song index decodes as a mixed
+# radix number, most significant digit first:
+#
+#   row          permutation rank of the tone row, 0 .. 12! - 1
+#   transform    0 .. n_transforms - 1
+#   chords       n_chords digits, each a chord id 0 .. n_chord_names - 1
+#   rhythm       n_rhythm digits, each a duration id 0 .. n_durations - 1
+#
+# The decoding is a bijection between 0 .. count - 1 and the song
+# records of song_codec, so workers handed disjoint index ranges can
+# never produce the same song and no shared set is needed.
+#
+# IndexShuffle permutes the index space (a keyed Feistel network with
+# cycle walking), so walking a range of shuffled indexes visits songs in
+# a varied order while keeping the same guarantee.
+
+
+# Permutation of range(n) with lexicographic rank index (Lehmer code)
+def unrank_permutation(index, n=12):
+    items = list(range(n))
+    perm = []
+    for i in range(n - 1, -1, -1):
+        digit, index = divmod(index, factorial(i))
+        perm.append(items.pop(digit))
+    return perm
+
+def rank_permutation(perm):
+    items = sorted(perm)
+    index = 0
+    for i, item in enumerate(perm):
+        digit = items.index(item)
+        index += digit * factorial(len(perm) - 1 - i)
+        items.pop(digit)
+    return index
+
+
+class SongSpace:
+    def __init__(self, n_chord_names, n_durations, n_chords=4, n_rhythm=12, n_transforms=4):
+        self.n_chord_names = n_chord_names
+        self.n_durations = n_durations
+        self.n_chords = n_chords
+        self.n_rhythm = n_rhythm
+        self.n_transforms = n_transforms
+        self.n_rows = factorial(12)
+        self.count = self.n_rows * n_transforms * n_chord_names ** n_chords * n_durations ** n_rhythm
+
+    # Song index -> (row, transform, chord_ids, rhythm_ids)
+    def song(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(f"Song index {index} out of range 0 .. {self.count - 1}")
+        rhythm_ids = []
+        for _ in range(self.n_rhythm):
+            index, digit = divmod(index, self.n_durations)
+            rhythm_ids.append(digit)
+        chord_ids = []
+        for _ in range(self.n_chords):
+            index, digit = divmod(index, self.n_chord_names)
+            chord_ids.append(digit)
+        index, transform = divmod(index, self.n_transforms)
+        return unrank_permutation(index), transform, chord_ids[::-1], rhythm_ids[::-1]
+
+    # Inverse of song
+    def index(self, row, transform, chord_ids, rhythm_ids):
+        index = rank_permutation(row) * self.n_transforms + transform
+        for digit in chord_ids:
+            index = index * self.n_chord_names + digit
+        for digit in rhythm_ids:
+            index = index * self.n_durations + digit
+        return index
+
+    # The index range [start, stop) of worker number worker out of
+    # n_workers, splitting the first total indexes evenly
+    @staticmethod
+    def worker_range(worker, n_workers, total):
+        return total * worker // n_workers, total * (worker + 1) // n_workers
+
+
+MASK64 = (1 << 64) - 1
+
+# splitmix64 finalizer, the Feistel round function
+def mix64(x):
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & MASK64
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EB & MASK64
+    return x ^ (x >> 31)
+
+
+class IndexShuffle:
+    def __init__(self, count, key, rounds=4):
+        self.count = count
+        bits = max(2, (count - 1).bit_length())
+        self.half_bits = (bits + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.round_keys = [mix64((key + i * 0x9E3779B97F4A7C15) & MASK64) for i in range(rounds)]
+
+    def _feistel(self, x):
+        left, right = x >> self.half_bits, x & self.half_mask
+        for round_key in self.round_keys:
+            left, right = right, left ^ (mix64(right ^ round_key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def _unfeistel(self, x):
+        left, right = x >> self.half_bits, x & self.half_mask
+        for round_key in reversed(self.round_keys):
+            left, right = right ^ (mix64(left ^ round_key) & self.half_mask), left
+        return (left << self.half_bits) | right
+
+    # Cycle walking: the network permutes 0 .. 4^half_bits - 1, which is
+    # less than 4 * count, so re-applying it until the result falls below
+    # count takes few steps and stays a permutation of 0 .. count - 1
+    def permute(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(f"Index {index} out of range 0 .. {self.count - 1}")
+        index = self._feistel(index)
+        while index >= self.count:
+            index = self._feistel(index)
+        return index
+
+    def inverse(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError(f"Index {index} out of range 0 .. {self.count - 1}")
+        index = self._unfeistel(index)
+        while index >= self.count:
+            index = self._unfeistel(index)
+        return index
@@ -0,0 +1,203 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from song_codec import HASH_NAME
+
+
+#////////////////////////////////////////////////////////////////////////
+#///////////////////// SONG SINK ////////////////////////////////////////
+#////////////////////////////////////////////////////////////////////////
+
+# Writes generated songs to disk as fixed-width binary shards instead of
+# printing them, and reads them back as memory-mapped numpy arrays.
+#
+# A shard file starts with a 32 byte header
+#
+#   magic        8s   b'SONGSHRD'
+#   version      u4
+#   record_size  u4   bytes of one song_codec record
+#   count        u8   songs in the shard
+#   first        u8   song number of the first song (over all shards)
+#
+# followed by count entries of (hash u8, record record_size bytes). The
+# songs are buffered and written buffer_records at a time; a shard is
+# closed and a new one started once it reaches max_shard_bytes.
+#
+# Every closed shard gets a sorted hash index next to it (.idx: the
+# entry numbers ordered by hash) so a song can be looked up by hash, and
+# index.json in the sink directory lists the shards with their first
+# song number and count, the run_info (run seed etc.) of every run
+# written to the sink, for replay, and the song_codec HASH_NAME the
+# hashes were made with. A sink made with another hash is refused.
+
+MAGIC = b"SONGSHRD"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQ")
+INDEX_NAME = "index.json"
+
+
+def entry_dtype(record_size):
+    return np.dtype([("hash", "<u8"), ("record", "u1", (record_size,))])
+
+
+def check_hash(index, path):
+    if index.get("hash") != HASH_NAME:
+        raise ValueError(f"Song sink {path} was written with hash {index.get('hash')}, not {HASH_NAME}")
+
+
+class SongSink:
+    def __init__(self, path, record_size, max_shard_bytes=256 << 20, buffer_records=65536, run_info=None):
+        self.path = path
+        self.record_size = record_size
+        self.dtype = entry_dtype(record_size)
+        # The hash index holds uint32 entry numbers
+        self.max_shard_records = min(max(1, (max_shard_bytes - HEADER.size) // self.dtype.itemsize), 0xFFFFFFFF)
+        self.buffer_records = buffer_records
+        os.makedirs(path, exist_ok=True)
+
+        index_path = os.path.join(path, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            check_hash(index, path)
+            self.shards = index["shards"]
+            self.runs = index.get("runs", [])
+        else:
+            self.shards = []
+            self.runs = []
+        self.written = sum(shard["count"] for shard in self.shards)
+        if run_info is not None:
+            self.runs.append(dict(run_info, first=self.written))
+            self._write_index()
+
+        self.buffer = []
+        self.buffered = 0
+        self.shard_file = None
+        self.shard_count = 0
+
+    # Adds songs: records (n, record_size) uint8 and their hashes (n,)
+    def write(self, records, hashes):
+        entries = np.empty(len(hashes), dtype=self.dtype)
+        entries["hash"] = hashes
+        entries["record"] = records
+        self.buffer.append(entries)
+        self.buffered += len(entries)
+        if self.buffered >= self.buffer_records:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        entries = np.concatenate(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+        while len(entries):
+            if self.shard_file is None:
+                self._open_shard()
+            count = min(len(entries), self.max_shard_records - self.shard_count)
+            self.shard_file.write(entries[:count].tobytes())
+            self.shard_count += count
+            self.written += count
+            entries = entries[count:]
+            if self.shard_count == self.max_shard_records:
+                self._close_shard()
+
+    def _shard_name(self, number):
+        return f"songs-{number:06d}.bin"
+
+    def _open_shard(self):
+        name = self._shard_name(len(self.shards))
+        self.shard_first = self.written
+        self.shard_count = 0
+        self.shard_file = open(os.path.join(self.path, name), "wb")
+        self.shard_file.write(HEADER.pack(MAGIC, VERSION, self.record_size, 0, self.shard_first))
+
+    # Writes the final count into the header, the hash index next to the
+    # shard and the shard into index.json
+    def _close_shard(self):
+        name = self._shard_name(len(self.shards))
+        self.shard_file.seek(0)
+        self.shard_file.write(HEADER.pack(MAGIC, VERSION, self.record_size, self.shard_count, self.shard_first))
+        self.shard_file.close()
+        self.shard_file = None
+
+        entries = read_shard(os.path.join(self.path, name))
+        np.argsort(entries["hash"], kind="stable").astype(np.uint32).tofile(
+            os.path.join(self.path, name[:-4] + ".idx"))
+
+        self.shards.append({"file": name, "first": self.shard_first, "count": self.shard_count})
+        self._write_index()
+
+    def _write_index(self):
+        with open(os.path.join(self.path, INDEX_NAME), "w") as index_file:
+            json.dump({"record_size": self.record_size, "hash": HASH_NAME, "shards": self.shards,
+                       "runs": self.runs}, index_file, indent=2)
+
+    def close(self):
+        self.flush()
+        if self.shard_file is not None:
+            self._close_shard()
+
+
+# A shard as a memory-mapped array of (hash, record) entries
+def read_shard(shard_path):
+    with open(shard_path, "rb") as shard_file:
+        magic, version, record_size, count, _ = HEADER.unpack(shard_file.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{shard_path} is not a song shard")
+    if not count:
+        return np.empty(0, dtype=entry_dtype(record_size))
+    return np.memmap(shard_path, dtype=entry_dtype(record_size), mode="r", offset=HEADER.size, shape=(count,))
+
+
+class SongShards:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME)) as index_file:
+            index = json.load(index_file)
+        check_hash(index, path)
+        self.record_size = index["record_size"]
+        self.shards = index["shards"]
+        self.runs = index.get("runs", [])
+
+    def __len__(self):
+        return sum(shard["count"] for shard in self.shards)
+
+    def shard(self, number):
+        return read_shard(os.path.join(self.path, self.shards[number]["file"]))
+
+    def __iter__(self):
+        for number in range(len(self.shards)):
+            yield self.shard(number)
+
+    # Song number -> record bytes
+    def __getitem__(self, song_number):
+        for number, shard in enumerate(self.shards):
+            if shard["first"] <= song_number < shard["first"] + shard["count"]:
+                return self.shard(number)["record"][song_number - shard["first"]].tobytes()
+        raise IndexError(f"Song {song_number} not in the shards")
+
+    # Record bytes of the song with this hash, or None: a binary search
+    # of every shard's hash index, reading only the entries it visits
+    def find(self, song_hash):
+        song_hash = np.uint64(song_hash)
+        for number, shard in enumerate(self.shards):
+            if not shard["count"]:
+                continue
+            entries = self.shard(number)
+            hashes = entries["hash"]
+            order = np.memmap(os.path.join(self.path, shard["file"][:-4] + ".idx"), dtype=np.uint32, mode="r")
+            lo, hi = 0, len(order)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if hashes[order[mid]] < song_hash:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(order) and hashes[order[lo]] == song_hash:
+                return entries["record"][order[lo]].tobytes()
+        return None
@@ -0,0 +1,156 @@
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+#////////////////////////////////////////////////////////////////////////
+#///////////////////// SONG TRANSPORT ///////////////////////////////////
+#////////////////////////////////////////////////////////////////////////
+
+# Moves song records from producer processes to the consumer through
+# shared memory instead of a multiprocessing.Queue, so songs are not
+# pickled and piped one message at a time.
+#
+# Every producer has its own ring of n_slots slots in one shared memory
+# block. A slot holds a batch of up to batch_size fixed-width records
+# and their 64-bit hashes. A producer is the only writer of its ring's
+# head and the consumer the only writer of the tails, so no lock is
+# needed; two semaphores carry the signalling and the backpressure:
+#
+#   free[producer]  free slots of that producer's ring; a producer with
+#                   a full ring blocks here until the consumer catches up
+#   filled          filled slots over all rings; the consumer blocks
+#                   here until any producer has a batch
+#
+# The consumer drains every filled slot it can get without waiting (up
+# to max_records songs) in one call. A producer blocked on a full ring
+# can be released by a stop event when the consumer is done.
+
+INDEX_HEAD = 0
+INDEX_TAIL = 1
+STOP_POLL = 0.1     # seconds between looks at the stop event of a blocked put
+
+
+class SongTransport:
+    def __init__(self, n_producers, record_size, batch_size=4096, n_slots=8):
+        self.n_producers = n_producers
+        self.record_size = record_size
+        self.batch_size = batch_size
+        self.n_slots = n_slots
+        self.shm = shared_memory.SharedMemory(create=True, size=self._size())
+        self.owner = True
+        self.free = [multiprocessing.Semaphore(n_slots) for _ in range(n_producers)]
+        self.filled = multiprocessing.Semaphore(0)
+        self._map()
+        self.indexes[:] = 0
+        self.next_ring = 0
+
+    def _size(self):
+        rings = self.n_producers * self.n_slots
+        return 8 * (2 * self.n_producers + rings + rings * self.batch_size) + \
+            rings * self.batch_size * self.record_size
+
+    # Arrays over the shared memory block: head and tail per ring, record
+    # count per slot, then the hashes and the records of every slot
+    def _map(self):
+        n, slots, batch = self.n_producers, self.n_slots, self.batch_size
+        buf = self.shm.buf
+        offset = 0
+        self.indexes = np.ndarray((n, 2), dtype=np.int64, buffer=buf, offset=offset)
+        offset += self.indexes.nbytes
+        self.counts = np.ndarray((n, slots), dtype=np.int64, buffer=buf, offset=offset)
+        offset += self.counts.nbytes
+        self.hashes = np.ndarray((n, slots, batch), dtype=np.uint64, buffer=buf, offset=offset)
+        offset += self.hashes.nbytes
+        self.records = np.ndarray((n, slots, batch, self.record_size), dtype=np.uint8, buffer=buf, offset=offset)
+
+    # Producer processes get the transport as a Process argument and
+    # attach to the same block by name
+    def __getstate__(self):
+        return {"name": self.shm.name, "n_producers": self.n_producers, "record_size": self.record_size,
+                "batch_size": self.batch_size, "n_slots": self.n_slots,
+                "free": self.free, "filled": self.filled}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        name = state["name"]
+        del self.__dict__["name"]
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = False
+        self._map()
+        self.next_ring = 0
+
+    def writer(self, producer):
+        return SongRingWriter(self, producer)
+
+    # Returns (records, hashes) arrays of the songs in every filled slot
+    # that can be had without waiting, stopping once max_records songs
+    # are taken. Waits up to timeout seconds (None: for ever) for the
+    # first slot, returning empty arrays if none is filled by then
+    def get(self, max_records=None, timeout=None):
+        records, hashes = [], []
+        n_taken = 0
+        block = True
+        while True:
+            if not self.filled.acquire(block, timeout if block else None):
+                break
+            block = False
+            ring = self._filled_ring()
+            tail = int(self.indexes[ring, INDEX_TAIL])
+            slot = tail % self.n_slots
+            count = int(self.counts[ring, slot])
+            records.append(self.records[ring, slot, :count].copy())
+            hashes.append(self.hashes[ring, slot, :count].copy())
+            n_taken += count
+            self.indexes[ring, INDEX_TAIL] = tail + 1
+            self.free[ring].release()
+            if max_records is not None and n_taken >= max_records:
+                break
+
+        if not records:
+            return np.empty((0, self.record_size), dtype=np.uint8), np.empty(0, dtype=np.uint64)
+        return np.concatenate(records), np.concatenate(hashes)
+
+    # A ring with a filled slot, taking the rings in turn so no producer
+    # is starved
+    def _filled_ring(self):
+        for i in range(self.n_producers):
+            ring = (self.next_ring + i) % self.n_producers
+            if self.indexes[ring, INDEX_HEAD] != self.indexes[ring, INDEX_TAIL]:
+                self.next_ring = ring + 1
+                return ring
+        raise RuntimeError("Song transport signalled a batch but no ring has one")
+
+    def close(self):
+        self.indexes = self.counts = self.hashes = self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SongRingWriter:
+    def __init__(self, transport, producer):
+        self.transport = transport
+        self.producer = producer
+
+    # Writes records (n, record_size) and their hashes (n,) into the ring,
+    # a slot per batch_size records, blocking while the ring is full.
+    # With a stop event, gives up once it is set while waiting; returns
+    # False if it did
+    def put(self, records, hashes, stop=None):
+        transport = self.transport
+        ring = self.producer
+        for start in range(0, len(records), transport.batch_size):
+            count = min(transport.batch_size, len(records) - start)
+            while not transport.free[ring].acquire(timeout=None if stop is None else STOP_POLL):
+                if stop.is_set():
+                    return False
+            head = int(transport.indexes[ring, INDEX_HEAD])
+            slot = head % transport.n_slots
+            transport.records[ring, slot, :count] = records[start:start + count]
+            transport.hashes[ring, slot, :count] = hashes[start:start + count]
+            transport.counts[ring, slot] = count
+            transport.indexes[ring, INDEX_HEAD] = head + 1
+            transport.filled.release()
+        return True
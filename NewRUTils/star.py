@@ -1,8 +1,15 @@
 import numpy as np
-import random
-import hashlib
 import multiprocessing
 
+from unique_store import UniqueStore, ProducerFilter
+from song_index import SongSpace, IndexShuffle
+from song_transport import SongTransport
+from song_sink import SongSink
+from work_coordinator import WorkCoordinator
+from song_codec import TRANSFORM_TRANSPOSE, TRANSFORM_INVERT, TRANSFORM_RETROGRADE, \
+    encode_song, decode_song, encode_song_batch, song_hash_batch, record_size
+import pitch_class
+
 # Define the 12 notes in the chromatic scale
 notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 
@@ -162,6 +169,7 @@ note_probabilities = [1/12] * 12  # Equal probabilities for twelve-tone row
 # Define possible chords in a key (simplified for illustration) with probabilities
 
 chord_probabilities = [0.20, 0.15, 0.15, 0.15, 0.20, 0.10, 0.05]  # Example probabilities
+chord_names = list(chords)[:len(chord_probabilities)]  # The chords the probabilities are for
 
 # Define possible note durations with probabilities
 durations = ['quarter', 'eighth', 'half', 'whole']
@@ -175,8 +183,8 @@ duration_probabilities = [0.4, 0.3, 0.2, 0.1]  # Example probabilities
 
 
 # Generate twelve-tone row using numpy's random.choice with probabilities # NO RANDOM!
-def generate_twelve_tone_row():
-    return np.random.choice(notes, size=12, replace=False).tolist()
+def generate_twelve_tone_row(rng=None):
+    return [notes[pc] for pc in generate_row_pcs(rng)]
 
 # Create twelve-tone matrix
 def create_twelve_tone_matrix(row):
@@ -186,28 +194,144 @@ def create_twelve_tone_matrix(row):
     return matrix
 
 # Generate chord progressions using numpy's random.choice with probabilities
-def generate_chord_progression(length):
-    return np.random.choice(chords, size=length, p=chord_probabilities).tolist()
+def generate_chord_progression(length, rng=None):
+    return [chord_names[i] for i in generate_chord_ids(length, rng)]
 
 # Generate rhythmic patterns using numpy's random.choice with probabilities
-def generate_rhythmic_pattern(length):
-    return np.random.choice(durations, size=length, p=duration_probabilities).tolist()
+def generate_rhythmic_pattern(length, rng=None):
+    return [durations[i] for i in generate_rhythm_ids(length, rng)]
+
+# The same as ids for the song record: pitch classes 0-11 for the row,
+# indexes into chord_names and durations for the chords and rhythm. One
+# song is a batch of one. Producers pass their own rng (see
+# worker_seeds); without one a fresh unseeded generator is used
+def generate_row_pcs(rng=None):
+    return generate_rows(1, rng)[0].tolist()
+
+def generate_chord_ids(length, rng=None):
+    return sample_ids(chord_probabilities, length, rng).tolist()
+
+def generate_rhythm_ids(length, rng=None):
+    return sample_ids(duration_probabilities, length, rng).tolist()
+
+# Apply transformations. The note-name versions look up rows of the
+# pitch_class tables spelled as note names, so a single row skips numpy
+note_index = {note: i for i, note in enumerate(notes)}
+TRANSPOSE_NOTES = [[notes[pc] for pc in row] for row in pitch_class.TRANSPOSE]
+INVERT_NOTES = [[notes[pc] for pc in row] for row in pitch_class.INVERT]
 
-# Apply transformations
 def transpose(sequence, interval):
-    note_map = {note: i for i, note in enumerate(notes)}
-    transpose_map = {i: notes[(i + interval) % len(notes)] for i in range(len(notes))}
-    return [transpose_map[note_map[note]] for note in sequence]
+    row = TRANSPOSE_NOTES[interval % 12]
+    return [row[note_index[note]] for note in sequence]
 
+# Mirrors 0..11 onto 11..0, which is I11
 def invert(sequence):
-    note_map = {note: i for i, note in enumerate(notes)}
-    max_interval = max(note_map.values())
-    invert_map = {i: notes[max_interval - i] for i in range(len(notes))}
-    return [invert_map[note_map[note]] for note in sequence]
+    row = INVERT_NOTES[11]
+    return [row[note_index[note]] for note in sequence]
 
 def retrograde(sequence):
     return sequence[::-1]
 
+# Rebuild the full song (note names, matrix, melody) from its record.
+# melody is the song's melody in pitch classes, when already computed
+# for a batch; otherwise it is computed as a batch of one
+def expand_song(record, melody=None):
+    row_pcs, _, chord_ids, rhythm_ids = decode_song(record)
+    if melody is None:
+        melody = song_melodies(np.frombuffer(record, dtype=np.uint8)[None])[0]
+    twelve_tone_row = [notes[pc] for pc in row_pcs]
+    return {
+        'twelve_tone_row': twelve_tone_row,
+        'twelve_tone_matrix': create_twelve_tone_matrix(twelve_tone_row).tolist(),
+        'melody': [notes[pc] for pc in melody],
+        'chords': [chord_names[i] for i in chord_ids],
+        'rhythm': [durations[i] for i in rhythm_ids]
+    }
+
+
+
+#////////////////////////////////////////////////////////////////////////
+#///////////////////// BATCH GENERATION /////////////////////////////////
+#////////////////////////////////////////////////////////////////////////
+
+# Songs are generated n at a time as integer arrays, with a handful of
+# numpy calls per batch instead of several Python calls per song. A
+# record keeps the transform id rather than the melody; song_melodies
+# applies the transforms to a whole batch of records at once.
+
+# Random rows: argsort of a random matrix gives a uniformly random
+# permutation in every row
+def generate_rows(n, rng=None):
+    rng = rng or np.random.default_rng()
+    return rng.random((n, 12)).argsort(axis=1).astype(np.uint8)
+
+# Categorical sampling for any shape: uniform draws looked up in the
+# cumulative probabilities
+def sample_ids(probabilities, shape, rng=None):
+    rng = rng or np.random.default_rng()
+    cumulative = np.cumsum(probabilities)
+    ids = np.searchsorted(cumulative, rng.random(shape) * cumulative[-1], side='right')
+    return np.minimum(ids, len(probabilities) - 1).astype(np.uint8)
+
+# n random songs as (rows, transforms, chord_ids, rhythm_ids) arrays
+def generate_song_batch(n, rng=None, n_chords=4, n_rhythm=12):
+    rng = rng or np.random.default_rng()
+    rows = generate_rows(n, rng)
+    transforms = rng.integers(0, 4, n, dtype=np.uint8)
+    chord_ids = sample_ids(chord_probabilities, (n, n_chords), rng)
+    rhythm_ids = sample_ids(duration_probabilities, (n, n_rhythm), rng)
+    return rows, transforms, chord_ids, rhythm_ids
+
+# Melodies (n, 12) in pitch classes of records (n, record_size): each
+# transform applied to all the rows that have it by fancy indexing in
+# the pitch_class tables
+def song_melodies(records):
+    rows = records[:, :12]
+    transforms = records[:, 12]
+    melodies = rows.astype(np.int8)
+    selected = transforms == TRANSFORM_TRANSPOSE
+    melodies[selected] = pitch_class.transpose(rows[selected], 2)
+    selected = transforms == TRANSFORM_INVERT
+    melodies[selected] = pitch_class.invert(rows[selected], 11)
+    selected = transforms == TRANSFORM_RETROGRADE
+    melodies[selected] = pitch_class.retrograde(rows[selected])
+    return melodies
+
+# Run seeding: one run seed gives every producer an independent,
+# reproducible stream (SeedSequence.spawn), so forked producers do not
+# all inherit one generator state and repeat each other's songs. The
+# run seed is printed and recorded with the sink output; setting it as
+# run_seed replays the same stream in every producer
+def new_run_seed():
+    return np.random.SeedSequence().entropy
+
+def worker_seeds(run_seed, n_workers):
+    return np.random.SeedSequence(run_seed).spawn(n_workers)
+
+# The song space shuffle key of a run (enumerated songs)
+def run_shuffle_key(run_seed):
+    return int(np.random.SeedSequence(run_seed).generate_state(1, np.uint64)[0])
+
+# Batch producer: writes (records, hashes) arrays to its transport ring,
+# pre-filtered against the store at store_path when given, a quota of
+# songs claimed from the coordinator at a time until the target is met.
+# seed is the producer's SeedSequence from worker_seeds
+def generate_song_batches(ring, coordinator, store_path=None, batch_size=4096, seed=None):
+    prefilter = ProducerFilter(store_path) if store_path else None
+    rng = np.random.default_rng(seed)
+    while True:
+        _, count = coordinator.claim(batch_size)
+        if not count:
+            break
+        records = encode_song_batch(*generate_song_batch(count, rng))
+        hashes = song_hash_batch(records)
+        if prefilter:
+            keep = prefilter.filter_batch(hashes)
+            coordinator.give_back(count - int(keep.sum()))
+            records, hashes = records[keep], hashes[keep]
+        if not ring.put(records, hashes, coordinator.stop_event):
+            break
+
 
 
 
@@ -260,58 +384,146 @@ apply_transformation_state.transitions = {
 #                      UNI-GENERATOR                  #
 # Generate unique songs using FSM NO MORE RANDOM! ALSO USE DFA
 #/////////////////////////////////////////////////////////////
-def generate_unique_song(queue, fsm):
-    while True:
+def generate_unique_song(ring, fsm, coordinator, store_path=None, seed=None):
+    # With a store, songs are checked against it (read-only) in batches
+    # and songs it already has are not sent. Songs are claimed from the
+    # coordinator a batch at a time. All draws come from this producer's
+    # own stream (seed from worker_seeds)
+    prefilter = ProducerFilter(store_path) if store_path else None
+    rng = np.random.default_rng(seed)
+    batch = []
+    _, quota = coordinator.claim(PREFILTER_BATCH)
+    while quota:
         if fsm.get_current_state() == 'GenerateMelody':
-            twelve_tone_row = generate_twelve_tone_row()
-            twelve_tone_matrix = create_twelve_tone_matrix(twelve_tone_row)
-            melody = twelve_tone_matrix[0].tolist()
+            row_pcs = generate_row_pcs(rng)
             fsm.transition('next')
         elif fsm.get_current_state() == 'GenerateChord':
-            chords = generate_chord_progression(4)
+            chord_ids = generate_chord_ids(4, rng)
             fsm.transition('next')
         elif fsm.get_current_state() == 'GenerateRhythm':
-            rhythm = generate_rhythmic_pattern(12)  # Match the length of the twelve-tone row
+            rhythm_ids = generate_rhythm_ids(12, rng)  # Match the length of the twelve-tone row
             fsm.transition('next')
         elif fsm.get_current_state() == 'ApplyTransformation':
-            transformations = [melody, transpose(melody, 2), invert(melody), retrograde(melody)]
-            transformed_melody = random.choice(transformations)
-            song = {
-                'twelve_tone_row': twelve_tone_row,
-                'twelve_tone_matrix': twelve_tone_matrix.tolist(),
-                'melody': transformed_melody,
-                'chords': chords,
-                'rhythm': rhythm
-            }
-            # Create a unique hash for the song to ensure uniqueness
-            song_hash = hashlib.sha256(str(song).encode()).hexdigest()
-            queue.put((song, song_hash))
+            transform = int(rng.integers(4))
+            # Only the compact record and its 64-bit hash go through the
+            # transport; the consumer rebuilds the matrix and melody to print
+            batch.append(encode_song(row_pcs, transform, chord_ids, rhythm_ids))
+            if len(batch) == quota:
+                if not put_records(ring, batch, coordinator, prefilter):
+                    break
+                batch = []
+                _, quota = coordinator.claim(PREFILTER_BATCH)
             fsm.transition('next')
 
-# Consumer process to print songs and ensure uniqueness
-def consumer(queue, target):
-    unique_songs = set()
+PREFILTER_BATCH = 256
+CONSUMER_BATCH = 65536
+CONSUMER_POLL = 0.5     # seconds the consumer waits for songs before looking at the coordinator
+
+# Write a list of records to the ring as one (records, hashes) pair of
+# arrays, giving the songs the pre-filter drops back to the coordinator.
+# Returns False if the run stopped while the ring was full
+def put_records(ring, records, coordinator, prefilter=None):
+    records = np.frombuffer(b"".join(records), dtype=np.uint8).reshape(len(records), -1)
+    hashes = song_hash_batch(records)
+    if prefilter:
+        keep = prefilter.filter_batch(hashes)
+        coordinator.give_back(len(keep) - int(keep.sum()))
+        records, hashes = records[keep], hashes[keep]
+    return ring.put(records, hashes, coordinator.stop_event)
+
+# Every possible song, numbered (see song_index)
+song_space = SongSpace(len(chord_names), len(durations))
+
+# Enumerating producer: sends the songs at the positions it claims from
+# the coordinator of the song space shuffled with shuffle_key. Claimed
+# ranges never overlap, so no two producers make the same song and no
+# dedupe is needed
+def generate_indexed_songs(ring, coordinator, shuffle_key=0):
+    shuffle = IndexShuffle(song_space.count, shuffle_key)
+    while True:
+        start, count = coordinator.claim(PREFILTER_BATCH)
+        if not count:
+            break
+        if not put_records(ring, [encode_song(*song_space.song(shuffle.permute(index)))
+                                  for index in range(start, start + count)], coordinator):
+            break
+
+# Print one song in full
+def print_song(number, record, melody=None):
+    song = expand_song(record, melody)
+    print(f"Song {number}:")
+    print(f"Twelve-tone row: {song['twelve_tone_row']}")
+    print(f"Twelve-tone matrix:")
+    for row in song['twelve_tone_matrix']:
+        print(row)
+    print(f"Melody: {song['melody']}")
+    print(f"Chords: {song['chords']}")
+    print(f"Rhythm: {song['rhythm']}")
+    print("\n")
+
+# Consumer process to store songs and ensure uniqueness. Songs arrive
+# through the shared memory transport, drained in batches. The hashes
+# seen are kept in the disk-backed store at store_path, checked a batch
+# at a time; without a store (enumerated songs) every song is taken as
+# new. New songs are written to binary shards at sink_path (see
+# song_sink), and every print_every-th song is printed as a sample
+# (print_every=1 prints them all, 0 none). run_info (the run seed) is
+# recorded in the sink's index.
+#
+# The coordinator's target ends the run: new songs are accepted with it
+# (duplicates given back to the producers), it stops the producers once
+# the target is met, and songs still in flight are then drained and
+# counted as discarded
+def consumer(transport, coordinator, store_path=None, sink_path=None, print_every=1, run_info=None):
+    unique_songs = UniqueStore(store_path) if store_path else None
+    sink = SongSink(sink_path, transport.record_size, run_info=run_info) if sink_path else None
+    target = coordinator.target
     generated = 0
 
     while generated < target:
-        song, song_hash = queue.get()
-        if song_hash not in unique_songs:
-            unique_songs.add(song_hash)
-            generated += 1
-            # Print each song as it is generated
-            print(f"Song {generated}:")
-            print(f"Twelve-tone row: {song['twelve_tone_row']}")
-            print(f"Twelve-tone matrix:")
-            for row in song['twelve_tone_matrix']:
-                print(row)
-            print(f"Melody: {song['melody']}")
-            print(f"Chords: {song['chords']}")
-            print(f"Rhythm: {song['rhythm']}")
-            print("\n")
-            if generated % 1_000_000 == 0:  # Print progress every million songs
-                print(f"Generated {generated} unique songs")
-
-    print("Finished generating 20 billion unique songs.")
+        records, hashes = transport.get(CONSUMER_BATCH, timeout=CONSUMER_POLL)
+        if not len(hashes):
+            if coordinator.stopped():
+                break
+            continue
+        duplicates = 0
+        if unique_songs is not None:
+            new = unique_songs.add_batch(hashes)
+            duplicates = len(new) - int(new.sum())
+            records, hashes = records[new], hashes[new]
+        coordinator.discard(max(0, len(records) - (target - generated)))
+        records, hashes = records[:target - generated], hashes[:target - generated]
+        coordinator.accept(len(records), duplicates)
+        if sink is not None:
+            sink.write(records, hashes)
+
+        if print_every:
+            # Song numbers generated + 1 .. generated + len(records)
+            first = -(generated + 1) % print_every
+            sample = np.arange(first, len(records), print_every)
+            for i, melody in zip(sample.tolist(), song_melodies(records[sample])):
+                print_song(generated + 1 + i, records[i].tobytes(), melody)
+
+        before = generated
+        generated += len(records)
+        if generated // 1_000_000 > before // 1_000_000:  # Print progress every million songs
+            print(f"Generated {generated} unique songs")
+            if unique_songs is not None:
+                print(f"Unique store: {unique_songs.stats()}")
+
+    # Stop the producers and drain what they had in flight
+    coordinator.stop()
+    while True:
+        _, hashes = transport.get(timeout=CONSUMER_POLL)
+        if not len(hashes):
+            break
+        coordinator.discard(len(hashes))
+
+    if sink is not None:
+        sink.close()
+    if unique_songs is not None:
+        unique_songs.close()
+    print(f"Finished generating {generated} unique songs.")
 
 
 #//////////////////////////////////////////////////////////////
@@ -323,25 +535,66 @@ if __name__ == '__main__':
     target = 20_000_000_000  # 20 billion unique songs
     num_producers = multiprocessing.cpu_count() - 1  # Use all but one core for producers
 
-    queue = multiprocessing.Queue(maxsize=1000)
-
-    # Initialize FSM for each producer
-    fsms = [FSM(generate_melody_state) for _ in range(num_producers)]
-
-    # Create producer processes
-    producers = [multiprocessing.Process(target=generate_unique_song, args=(queue, fsms[i])) for i in range(num_producers)]
+    # One shared memory ring per producer
+    transport = SongTransport(num_producers, record_size(4, 12))
+
+    # Hands the target out to the producers in quotas and stops them
+    # once the consumer has it
+    coordinator = WorkCoordinator(target)
+
+    # Draw songs at random in numpy batches and dedupe (the fastest
+    # producers), or set to enumerate them by index: unique by
+    # construction, but each song is unranked and shuffled in Python,
+    # over ten times slower than a batch producer
+    enumerate_songs = False
+
+    # Set to the seed printed by an earlier run to replay it
+    run_seed = None
+    if run_seed is None:
+        run_seed = new_run_seed()
+    print(f"Run seed: {run_seed}")
+    seeds = worker_seeds(run_seed, num_producers)
+    shuffle_key = run_shuffle_key(run_seed)
+    run_info = {'seed': run_seed, 'producers': num_producers, 'enumerate': enumerate_songs}
+
+    if enumerate_songs:
+        store_path = None
+        producers = [multiprocessing.Process(target=generate_indexed_songs,
+                                             args=(transport.writer(i), coordinator, shuffle_key))
+                     for i in range(num_producers)]
+    else:
+        # Create the uniqueness store before any process opens it. 32-bit
+        # fingerprints at 0.8 load: about 140 GB of (sparse) shard files
+        # for the full target
+        store_path = 'star_songs.unique'
+        UniqueStore(store_path, capacity=target, fp_rate=1e-8).close()
+
+        # Create producer processes
+        producers = [multiprocessing.Process(target=generate_song_batches, args=(transport.writer(i), coordinator, store_path),
+                                             kwargs={'seed': seeds[i]})
+                     for i in range(num_producers)]
 
     # Create and start consumer process
-    consumer_process = multiprocessing.Process(target=consumer, args=(queue, target))
+    # Songs go to binary shards; one in a million is printed
+    sink_path = 'star_songs'
+    print_every = 1_000_000
+    consumer_process = multiprocessing.Process(target=consumer, args=(transport, coordinator, store_path, sink_path, print_every, run_info))
+    coordinator.start()
     consumer_process.start()
 
     # Start producer processes
     for producer in producers:
         producer.start()
 
-    # Wait for producer processes to finish
+    # Wait for the run to finish; Ctrl-C stops it cleanly as well
+    try:
+        consumer_process.join()
+    except KeyboardInterrupt:
+        coordinator.stop()
+        consumer_process.join()
+
+    # Producers exit once the coordinator has stopped the run
     for producer in producers:
         producer.join()
-
-    # Wait for consumer process to finish
-    consumer_process.join()
\ No newline at end of file
+    transport.close()
+    print(f"Run stats: {coordinator.stats()}")
@@ -1,7 +1,18 @@
 import struct
 import ctypes
+import time
 from ctypes import POINTER, Structure, c_void_p, c_uint, c_ulong, c_ushort, c_int, c_char_p
 
+import mmtimer
+from ring_buffer import MidiEventRing, MidiEvent
+from midi_out_registry import MidiOutRegistry
+from sysex_pool import SysexPool, SENDING_SYSEX
+from note_state import NoteState
+from midi_encoder import MidiEncoder
+from clock_tracker import ClockTracker
+from sync_stats import SyncStats
+from tempo_map import BuildTempoMap, TempoMapSource, SkipMidiOutEvents
+
 
 #-----------------------------------------------------------------------------
 # Function Prototype used in this dylib module
@@ -9,16 +20,65 @@ from ctypes import POINTER, Structure, c_void_p, c_uint, c_ulong, c_ushort, c_in
 
 
 def InsertInSysexBuffer(lpMidiOut, thisEvent):
-    # Simulate inserting a SysEx event into the buffer
-    pass
+    # Start sending the pooled SysEx buffer named by the event. The port
+    # loses running status once it is sent.
+    lpMidiOut.lpEncoder.ClearRunningStatus()
+    lpSync = lpMidiOut.lpSync
+    lpSync.lpSysexPool.Insert(lpSync, lpMidiOut, thisEvent)
 
 def TrackMidiOut(lpMidiOut, dwMsg):
-    # Simulate tracking MIDI output messages
-    pass
+    # Keep track of the notes sounding on the output
+    lpMidiOut.lpNoteState.Track(dwMsg)
 
 def TurnNotesOff(lpMidiOut):
-    # Simulate turning off all currently playing notes
-    pass
+    # Turn off the notes still sounding, in one write to the port
+    data = lpMidiOut.lpNoteState.NotesOff()
+    if data:
+        FlushMidiOut(lpMidiOut)
+        midiOutWrite(lpMidiOut.hMidiOut, data)
+        lpMidiOut.lpEncoder.ClearRunningStatus()
+
+def FlushMidiOut(lpMidiOut):
+    # Write the messages encoded for the output since the last flush
+    if lpMidiOut.lpEncoder.Pending():
+        midiOutWrite(lpMidiOut.hMidiOut, lpMidiOut.lpEncoder.Take())
+
+def ResetMidiOut16(lpMidiOut):
+    # Simulate resetting a MIDI output. Sounding notes are turned off and
+    # SysEx being sent is dropped.
+    TurnNotesOff(lpMidiOut)
+    lpSync = lpMidiOut.lpSync
+    if lpSync is not None:
+        lpSync.lpSysexPool.Abort(lpSync, lpMidiOut)
+
+def midiOutShortMsg(hMidiOut, dwMsg):
+    # Simulate sending a short MIDI message to the output device. Device
+    # objects that accept messages directly (such as the virtual clock's
+    # capture devices) are handed the message.
+    if hasattr(hMidiOut, "ShortMsg"):
+        return hMidiOut.ShortMsg(dwMsg)
+    return 0
+
+def midiOutLongMsg(hMidiOut, data):
+    # Simulate sending (part of) a SysEx message. data is a memoryview
+    # into a pooled buffer, only valid for the duration of the call.
+    if hasattr(hMidiOut, "LongMsg"):
+        return hMidiOut.LongMsg(data)
+    return 0
+
+def midiOutWrite(hMidiOut, data):
+    # Simulate writing a string of complete short messages (running
+    # status allowed) to the output port in one transfer.
+    if hasattr(hMidiOut, "Write"):
+        return hMidiOut.Write(data)
+    return 0
+
+def PostMessage(hWnd, msg, wParam, lParam):
+    # Simulate posting a message to the application window. A callable
+    # hWnd receives the message directly.
+    if callable(hWnd):
+        hWnd(msg, wParam, lParam)
+    return 1
 
 
 #-----------------------------------------------------------------------------
@@ -55,43 +115,129 @@ def TurnNotesOff(lpMidiOut):
 MXMIDIERR_MAXERR = -1
 USE_CURRENT = -1
 MMSYSERR_ALLOCATED = 4
+TIMERR_NOERROR = 0
+TIMERR_NOCANDO = 97
+
+# timeSetEvent flags
+TIME_ONESHOT = mmtimer.TIME_ONESHOT
+TIME_PERIODIC = mmtimer.TIME_PERIODIC
+
+# Tempo is held internally in uS/beat * SCALE, matching the 256000 factor
+# in dwTRtime, so that fractional tempos survive the integer arithmetic
+SCALE = 256
+
+# Sync flags (wFlags)
+SYNC_RUNNING = 0x02
+SENT_SYNCDONE = 0x08
+
+# MIDI out flags (dwFlags)
+SYNC_OUTPUT = 0x08
 
 # Define structures
 class TIMECAPS(Structure):
     _fields_ = [("wPeriodMin", c_uint),
                 ("wPeriodMax", c_uint)]
 
-class SyncStruct(Structure):
-    _fields_ = [("hWnd", c_void_p),
-                ("wSyncMode", c_ushort),
-                ("wFlags", c_ushort),
-                ("nSysexBuffsActive", c_uint),
-                ("wTimerPeriod", c_ushort),
-                ("wTimerID", c_uint),
-                ("lpMidiOutList", POINTER(c_void_p))]
+#-----------------------------------------------------------------------------
+# SyncState
+#
+# The sync structure. lpSync (and the hSync handle returned by OpenSync16)
+# is one of these. Every field the engine uses is declared in __slots__,
+# so sync() reads plain Python attributes and assigning to a misspelled
+# field raises AttributeError.
+#-----------------------------------------------------------------------------
+class SyncState:
+    __slots__ = ("hWnd",                # window (callable) receiving messages
+                 "wSyncMode",           # "S_INT" or "S_MIDI"
+                 "wFlags",              # SYNC_RUNNING, SENT_SYNCDONE, IN_SYNC, ...
+                 "nSysexBuffsActive",   # SysEx buffers being sent
+                 "wTimerPeriod",        # mS per sync() call
+                 "wTimerID",
+                 "wBlockPeriod",        # mS per wakeup in block mode, 0 if off
+                 "nsBlockLast",         # monotonic nS serviced up to in block mode
+                 "wResolution",         # ticks per beat
+                 "nTicksPerClock",      # ticks per MIDI clock
+                 "dwTempo",             # uS per beat * SCALE
+                 "dwTRtime",            # resolution * timer period, scaled
+                 "dwFticks",            # fractional ticks
+                 "dwTicks",             # song position in ticks
+                 "dwLastTicks",         # ticks at the last MIDI clock (S_MIDI)
+                 "wTempoTicks",         # ticks since the last MIDI clock (S_MIDI)
+                 "nTicksSinceClock",
+                 "nTicksSinceBeat",
+                 "msPosition",          # song position in mS
+                 "lpMidiOutList",       # MidiOutRegistry of attached outputs
+                 "lpSyncIn",            # sync input receiving tempo events
+                 "lpScheduler",         # lookahead scheduler, if used
+                 "lpStats",
+                 "lpTempoMap",
+                 "lpSysexPool",
+                 "lpClockTracker")      # tempo estimate of the S_MIDI master
+
+    def __init__(self):
+        self.hWnd = None
+        self.wSyncMode = "S_INT"
+        self.wFlags = 0
+        self.nSysexBuffsActive = 0
+        self.wTimerPeriod = 1
+        self.wTimerID = None
+        self.wBlockPeriod = 0
+        self.nsBlockLast = None
+        self.wResolution = 480
+        self.nTicksPerClock = 20
+        self.dwTempo = 500000 * SCALE
+        self.dwTRtime = 0
+        self.dwFticks = 0
+        self.dwTicks = 0
+        self.dwLastTicks = 0
+        self.wTempoTicks = 0
+        self.nTicksSinceClock = 0
+        self.nTicksSinceBeat = 0
+        self.msPosition = 0
+        self.lpMidiOutList = None
+        self.lpSyncIn = None
+        self.lpScheduler = None
+        self.lpStats = None
+        self.lpTempoMap = None
+        self.lpSysexPool = None
+        self.lpClockTracker = None
+
+    # A valid handle always compares above the error range, so the
+    # "hSync <= MXMIDIERR_MAXERR" guards work on a live handle
+    def __le__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
 
 # Define helper functions
+# The time* functions are backed by the drift-compensated timer threads in
+# mmtimer, so syncTimer fires on hosts without the multimedia timer.
 def timeGetDevCaps(timeCaps, size):
-    # Simulate getting timer capabilities
-    timeCaps.wPeriodMin = 1
-    timeCaps.wPeriodMax = 1000
-    return 0
+    # Report the periods the monotonic clock can support
+    timeCaps.wPeriodMin = mmtimer.GetPeriodMin()
+    timeCaps.wPeriodMax = 1000000
+    return TIMERR_NOERROR
 
 def timeBeginPeriod(period):
-    # Simulate starting a timer period
-    return 0
+    # Timer threads always run at full resolution; only check the period
+    if period < mmtimer.GetPeriodMin():
+        return TIMERR_NOCANDO
+    return TIMERR_NOERROR
 
 def timeEndPeriod(period):
-    # Simulate ending a timer period
-    pass
+    # Nothing to release
+    return TIMERR_NOERROR
 
 def timeSetEvent(period, resolution, callback, user, flags):
-    # Simulate setting a timer event
-    return 1
+    # Start a timer thread, returns its id or None if the period is too short
+    return mmtimer.SetTimer(period, callback, user, flags)
 
 def timeKillEvent(timer_id):
-    # Simulate killing a timer event
-    pass
+    # Stop the timer thread
+    if timer_id is None or not mmtimer.KillTimer(timer_id):
+        return TIMERR_NOCANDO
+    return TIMERR_NOERROR
 
 def SetResolution16(hSync, resolution):
     # Simulate setting resolution
@@ -111,7 +257,7 @@ def OpenSync16(hSync, hWnd, mode, wTimerPeriod):
     lpSY = None
 
     # Check if already open
-    if hSync > MXMIDIERR_MAXERR and hSync is not None:
+    if hSync and hSync > MXMIDIERR_MAXERR:
         lpSY = hSync
 
         # If timer was active, kill the timer
@@ -120,8 +266,15 @@ def OpenSync16(hSync, hWnd, mode, wTimerPeriod):
             timeEndPeriod(lpSY.wTimerPeriod)
     else:
         # Allocate memory for the sync structure
-        lpSY = SyncStruct()
-        lpSY.lpMidiOutList = POINTER(c_void_p)()
+        lpSY = SyncState()
+        lpSY.lpMidiOutList = MidiOutRegistry()
+        lpSY.lpStats = SyncStats()
+        lpSY.lpSysexPool = SysexPool(midiOutLongMsg)
+        lpSY.lpClockTracker = ClockTracker()
+
+    # Reopening returns to one sync() per interrupt
+    lpSY.wBlockPeriod = 0
+    lpSY.nsBlockLast = None
 
     # Set the handle to the window that receives messages
     lpSY.hWnd = hWnd
@@ -159,11 +312,12 @@ def OpenSync16(hSync, hWnd, mode, wTimerPeriod):
         FreeGlobalMem16(lpSY)
         return MMSYSERR_ALLOCATED
 
-    # Start the timer
-    lpSY.wTimerID = timeSetEvent(lpSY.wTimerPeriod, lpSY.wTimerPeriod, None, lpSY, 0)
-    if lpSY.wTimerID is None:
-        FreeGlobalMem16(lpSY)
-        return MMSYSERR_ALLOCATED
+    # Start the timer, unless a lookahead scheduler is dispatching
+    if lpSY.lpScheduler is None:
+        lpSY.wTimerID = timeSetEvent(lpSY.wTimerPeriod, lpSY.wTimerPeriod, syncTimer, lpSY, TIME_PERIODIC)
+        if lpSY.wTimerID is None:
+            FreeGlobalMem16(lpSY)
+            return MMSYSERR_ALLOCATED
 
     return lpSY
 
@@ -183,6 +337,11 @@ def CloseSync16(hSync):
 
     lpSync = hSync
 
+    # Stop the lookahead scheduler thread, if one is dispatching
+    if lpSync.lpScheduler is not None:
+        lpSync.lpScheduler.Stop()
+        lpSync.lpScheduler = None
+
     # Was internal sync enabled?
     if lpSync.wTimerID is not None:
         # Stop the timer
@@ -192,10 +351,9 @@ def CloseSync16(hSync):
         timeEndPeriod(lpSync.wTimerPeriod)
 
     # Disconnect all attached MIDI out devices from this sync device
-    lpMOL = lpSync.lpMidiOutList
-    while lpMOL and lpMOL.contents:
-        lpMOL.contents.lpSync = None
-        lpMOL = ctypes.cast(ctypes.addressof(lpMOL.contents) + ctypes.sizeof(c_void_p), POINTER(c_void_p))
+    for lpMO in list(lpSync.lpMidiOutList):
+        lpSync.lpMidiOutList.Detach(lpMO)
+        lpMO.lpSync = None
 
     # Free the lpMidiOutList structure
     FreeGlobalMem16(lpSync.lpMidiOutList)
@@ -227,19 +385,14 @@ def StopSync16(hSync):
     # Disable the timer
     lpSync.wFlags = 0
 
-    # Reset MIDI out for each output
-    lpMOL = lpSync.lpMidiOutList
-    while lpMOL and lpMOL.contents:
-        lpMO = lpMOL.contents
-
-        # Send MIDI stop if not in MIDI clock sync mode
-        if lpSync.wSyncMode != "S_MIDI":  # Assuming "S_MIDI" is defined elsewhere
-            if lpMO.dwFlags & "SYNC_OUTPUT":  # Assuming "SYNC_OUTPUT" is defined elsewhere
-                midiOutShortMsg(lpMO.hMidiOut, 0xFC)  # 0xFC is MIDI_STOP
+    # Send MIDI stop if not in MIDI clock sync mode
+    if lpSync.wSyncMode != "S_MIDI":  # Assuming "S_MIDI" is defined elsewhere
+        for hMidiOut in lpSync.lpMidiOutList.Handles(SYNC_OUTPUT):
+            midiOutShortMsg(hMidiOut, 0xFC)  # 0xFC is MIDI_STOP
 
-        # Reset the output
+    # Reset MIDI out for each output
+    for lpMO in lpSync.lpMidiOutList:
         ResetMidiOut16(lpMO)
-        lpMOL = ctypes.cast(ctypes.addressof(lpMOL.contents) + ctypes.sizeof(c_void_p), POINTER(c_void_p))
 
 
 #-----------------------------------------------------------------------------
@@ -274,27 +427,25 @@ def PauseSync16(hSync, reset):
 
     # If the reset parameter is True, reset MIDI out for each output
     if reset:
-        lpMOL = lpSync.lpMidiOutList
-        while lpMOL and lpMOL.contents:
-            lpMO = lpMOL.contents
-
-            # Send MIDI stop if not in MIDI clock sync mode
-            if lpSync.wSyncMode != "S_MIDI":  # Assuming "S_MIDI" is defined elsewhere
-                SYNC_OUTPUT = 0x08  # Assuming SYNC_OUTPUT is defined as 0x08
-                if lpMO.dwFlags & SYNC_OUTPUT:
-                    midiOutShortMsg(lpMO.hMidiOut, 0xFC)  # 0xFC is MIDI_STOP
+        # Send MIDI stop if not in MIDI clock sync mode
+        if lpSync.wSyncMode != "S_MIDI":  # Assuming "S_MIDI" is defined elsewhere
+            for hMidiOut in lpSync.lpMidiOutList.Handles(SYNC_OUTPUT):
+                midiOutShortMsg(hMidiOut, 0xFC)  # 0xFC is MIDI_STOP
 
-            # Turn off any currently playing notes
+        # Turn off any currently playing notes
+        for lpMO in lpSync.lpMidiOutList:
             TurnNotesOff(lpMO)
-
-            # Move to the next MIDI output
-            lpMOL = ctypes.cast(ctypes.addressof(lpMOL.contents) + ctypes.sizeof(c_void_p), POINTER(c_void_p))
 #-----------------------------------------------------------------------------
 # StartSync
 # Enables the sync device and clears the ticks count
 
+# dwStartTicks starts playback part way through the queued sequence. The
+# tempo map (built by BuildTempoMap16 if not already built for the
+# sequence now loaded) gives the ms position and tempo at that tick, and
+# the events before it are dropped from the output buffers instead of
+# being played out.
 #---------------------------------------------------------------------
-def StartSync16(hSync):
+def StartSync16(hSync, dwStartTicks=0):
     # If not open, ignore request
     if hSync is None or hSync <= MXMIDIERR_MAXERR:
         return
@@ -303,19 +454,39 @@ def StartSync16(hSync):
 
     # Reset sync
     lpSync.dwFticks = 0
-    lpSync.dwTicks = 0
-    lpSync.nTicksSinceClock = 0
-    lpSync.nTicksSinceBeat = 0
+    lpSync.dwTicks = dwStartTicks
+    lpSync.nTicksSinceClock = dwStartTicks % lpSync.nTicksPerClock
+    lpSync.nTicksSinceBeat = dwStartTicks % lpSync.wResolution
     lpSync.wTempoTicks = 0
-    lpSync.dwLastTicks = 0
+    lpSync.dwLastTicks = dwStartTicks
     lpSync.msPosition = 0
 
     # Clear the time of the last event
-    lpMOL = lpSync.lpMidiOutList
-    while lpMOL and lpMOL.contents:
-        lpMO = lpMOL.contents
+    for lpMO in lpSync.lpMidiOutList:
         lpMO.dwLastEventTicks = 0
-        lpMOL = ctypes.cast(ctypes.addressof(lpMOL.contents) + ctypes.sizeof(c_void_p), POINTER(c_void_p))
+
+    # Seek to the start position
+    if dwStartTicks:
+        lpTempoMap = lpSync.lpTempoMap
+        if lpTempoMap is None or lpTempoMap.source != TempoMapSource(lpSync, lpSync.lpMidiOutList):
+            lpTempoMap = BuildTempoMap16(hSync)
+
+        lpSync.msPosition = int(lpTempoMap.TicksToMs(dwStartTicks))
+        lpSync.dwTempo = lpTempoMap.TempoAt(dwStartTicks) * SCALE
+
+        for lpMO in lpSync.lpMidiOutList:
+            lpSync.lpSysexPool.ReleaseEvents(SkipMidiOutEvents(lpMO, dwStartTicks))
+
+    # The next event of each output is now relative to the new last event
+    for lpMO in lpSync.lpMidiOutList:
+        lpSync.lpMidiOutList.UpdateDue(lpMO)
+
+    # Re-anchor the lookahead scheduler, if one is driving this device
+    if lpSync.lpScheduler is not None:
+        lpSync.lpScheduler.Reset()
+
+    # Tempo tracking of a MIDI clock master starts again
+    lpSync.lpClockTracker.Reset()
 
     # Restart sync
     ReStartSync16(hSync)
@@ -341,25 +512,21 @@ def ReStartSync16(hSync):
     # If it's not S_MIDI sync...
     if lpSync.wSyncMode != "S_MIDI":  # Assuming "S_MIDI" is defined elsewhere
         # Start the timer running (if S_MIDI, it will be started by reception of MIDI_START message)
-        SYNC_RUNNING = 0x02  # Assuming SYNC_RUNNING is defined as 0x02
         lpSync.wFlags |= SYNC_RUNNING
 
         # Send start if not MIDI sync
-        lpMOL = lpSync.lpMidiOutList
-        while lpMOL and lpMOL.contents:
-            lpMO = lpMOL.contents
-            SYNC_OUTPUT = 0x08  # Assuming SYNC_OUTPUT is defined as 0x08
-            if lpMO.dwFlags & SYNC_OUTPUT:
-                midiOutShortMsg(lpMO.hMidiOut, 0xFA)  # 0xFA is MIDI_START
-
-            # Move to the next MIDI output
-            lpMOL = ctypes.cast(ctypes.addressof(lpMOL.contents) + ctypes.sizeof(c_void_p), POINTER(c_void_p))
+        for hMidiOut in lpSync.lpMidiOutList.Handles(SYNC_OUTPUT):
+            midiOutShortMsg(hMidiOut, 0xFA)  # 0xFA is MIDI_START
     else:
         # Restore the status of the SYNC_RUNNING flag for the S_MIDI sync mode
         RUNNING_STATUS = 0x01  # Assuming RUNNING_STATUS is defined as 0x01
         if lpSync.wFlags & RUNNING_STATUS:
             lpSync.wFlags &= ~RUNNING_STATUS
             lpSync.wFlags |= SYNC_RUNNING
+
+    # Let the lookahead scheduler pick up the new state
+    if lpSync.lpScheduler is not None:
+        lpSync.lpScheduler.Wake()
 #-----------------------------------------------------------------------------
 # setTempo
 # sets the current tempo. This function may be called at
@@ -383,9 +550,12 @@ def SetTempo16(hSync, uSPerBeat):
     lpSync = hSync
 
     # Set the tempo
-    SCALE = 1  # Assuming SCALE is defined as 1
     lpSync.dwTempo = uSPerBeat * SCALE
 
+    # Events already converted to milliseconds must follow the new tempo
+    if lpSync.lpScheduler is not None:
+        lpSync.lpScheduler.Retime()
+
     # Test for uninitialized lpSyncIn -- without a sync input device
     # there is no valid destination for (sync) tempo changes
     if (lpSync.wFlags & 0x02) and (lpSync.lpSyncIn is not None):  # Assuming SYNC_RUNNING is 0x02
@@ -395,26 +565,14 @@ def SetTempo16(hSync, uSPerBeat):
         dwTicks = lpSync.dwTicks - lpMidiIn.dwLastEventTicks
         lpMidiIn.dwLastEventTicks = lpSync.dwTicks
 
-        # Get a pointer to the buffer
-        Qptr = ctypes.cast(
-            ctypes.addressof(lpMidiIn.lpMidiInDataHead.contents) + lpMidiIn.pMidiInDataIn * ctypes.sizeof(lpMidiIn.lpMidiInDataHead.contents),
-            ctypes.POINTER(ctypes.c_void_p)
-        )
-
-        # Store the data in the buffer
-        Qptr.contents.time = dwTicks
-        Qptr.contents.status = 0
-        Qptr.contents.data1 = (uSPerBeat >> 16) & 0xFF
-        Qptr.contents.data2 = (uSPerBeat >> 8) & 0xFF
-        Qptr.contents.data3 = uSPerBeat & 0xFF
-
-        # If necessary, wrap the pointer
-        lpMidiIn.pMidiInDataIn += 1
-        if lpMidiIn.pMidiInDataIn == lpMidiIn.nMidiInSize:
-            lpMidiIn.pMidiInDataIn = 0
+        # Store the tempo event in the input buffer
+        lpMidiIn.lpMidiInData.PushEvent(dwTicks, 0,
+                                        (uSPerBeat >> 16) & 0xFF,
+                                        (uSPerBeat >> 8) & 0xFF,
+                                        uSPerBeat & 0xFF)
 
         # Send a message to the application
-        PostMessage(lpMidiIn.hWnd, "MIDI_DATA", 0, ctypes.cast(lpMidiIn, ctypes.c_void_p))
+        PostMessage(lpMidiIn.hWnd, "MIDI_DATA", 0, lpMidiIn)
 
     return 0
 
@@ -448,14 +606,18 @@ def SetResolution16(hSync, resolution):
 #
 # Gets the current tempo.  The tempo is set in microseconds
 # per midi beat so that tempo may be set fractionally.
+# Following a MIDI clock master this is the master's estimated tempo;
+# the tempo actually run at is bent off it to stay on the clock count
+# (GetClockTracking16 reports the bend).
 #-----------------------------------------------------------------------------
 def GetTempo16(hSync):
     # If not open, ignore request
     if hSync is None or hSync <= MXMIDIERR_MAXERR:
         return 0
-    else:
-        SCALE = 1  # Assuming SCALE is defined as 1
-        return hSync.dwTempo // SCALE
+
+    if hSync.wSyncMode == "S_MIDI" and hSync.lpClockTracker.uSPerBeat is not None:
+        return int(hSync.lpClockTracker.uSPerBeat)
+    return hSync.dwTempo // SCALE
 
 #-----------------------------------------------------------------------------
 # GetResolution
@@ -470,6 +632,104 @@ def GetResolution16(hSync):
     else:
         return hSync.wResolution
 #-----------------------------------------------------------------------------
+# BuildTempoMap
+#
+# Indexes the tempo events of the sequence queued in the outputs, starting
+# from the current tempo. Call after loading the sequence and before
+# StartSync16; the map is used for seeking and position conversion.
+#-----------------------------------------------------------------------------
+def BuildTempoMap16(hSync):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return None
+
+    return BuildTempoMap(hSync, GetTempo16(hSync), hSync.lpMidiOutList)
+
+#-----------------------------------------------------------------------------
+# TicksToMs / MsToTicks
+#
+# Convert between a song position in ticks and in milliseconds, through
+# the tempo map if one has been built, otherwise at the current tempo.
+#-----------------------------------------------------------------------------
+def TicksToMs16(hSync, dwTicks):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return 0
+
+    if hSync.lpTempoMap is not None:
+        return hSync.lpTempoMap.TicksToMs(dwTicks)
+    return dwTicks * GetTempo16(hSync) / (hSync.wResolution * 1000.0)
+
+def MsToTicks16(hSync, ms):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return 0
+
+    if hSync.lpTempoMap is not None:
+        return hSync.lpTempoMap.MsToTicks(ms)
+    return int(ms * hSync.wResolution * 1000.0 / GetTempo16(hSync))
+
+#-----------------------------------------------------------------------------
+# GetSyncStats / ResetSyncStats
+#
+# Returns a snapshot of the sync loop counters: timer lateness and sync()
+# cost histograms, events sent per output per tick and the number of
+# timer ticks skipped because sync() was still running. ResetSyncStats
+# clears them, for example after changing wTimerPeriod.
+#-----------------------------------------------------------------------------
+def GetSyncStats16(hSync):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return None
+
+    return hSync.lpStats.Snapshot()
+
+def ResetSyncStats16(hSync):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return
+
+    hSync.lpStats.Reset()
+
+#-----------------------------------------------------------------------------
+# SetClockTracking / GetClockTracking
+#
+# nWindow is the number of recent MIDI clocks the S_MIDI tempo estimate
+# is fitted over: larger values give a steadier tempo from a jittery
+# master, smaller values follow its tempo changes sooner. fSlack is how
+# far (in clocks) the position may drift off the clock count before it
+# is corrected at once; 0 corrects on every clock. Within the slack the
+# tempo is bent to pull the position back over nPull clocks (default
+# nWindow / 4), so fSlack must be less than nPull.
+# GetClockTracking16 returns the current estimate and bend with the
+# measured jitter and drift of the master.
+#
+# returns 0 if successful, MXMIDIERR_BADPARAM if a parameter is out of
+# range.
+#-----------------------------------------------------------------------------
+def SetClockTracking16(hSync, nWindow, fSlack=0.25, nPull=None):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return "MXMIDIERR_BADHANDLE"
+
+    if nWindow < 2 or fSlack < 0 or (nPull is not None and nPull < 1):
+        return "MXMIDIERR_BADPARAM"
+    lpClockTracker = ClockTracker(nWindow, fSlack, nPull)
+    # Beyond nPull clocks of slack the bend would stop or reverse the tempo
+    if fSlack >= lpClockTracker.nPull:
+        return "MXMIDIERR_BADPARAM"
+
+    hSync.lpClockTracker = lpClockTracker
+    return 0
+
+def GetClockTracking16(hSync):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return None
+
+    return hSync.lpClockTracker.Snapshot()
+
+#-----------------------------------------------------------------------------
 #  GetPosition
 #
 #  Returns the current playback position in either milliseconds since the
@@ -495,6 +755,131 @@ def GetPosition16(hSync, units):
     return rc
 
 
+#-----------------------------------------------------------------------------
+# SendMidiOutEvent
+#
+# Sends one event taken from an output buffer. A status of zero is a tempo
+# change, SYSEX events go to the sysex buffers and everything else is
+# added to the output's encoder as a short message, to be written by
+# FlushMidiOut. Shared by the sync handler and the lookahead scheduler so
+# both dispatch events the same way.
+#-----------------------------------------------------------------------------
+def SendMidiOutEvent(lpSync, lpMO, thisEvent):
+    if thisEvent.status == 0:
+        newTempo = (thisEvent.data1 << 16) + (thisEvent.data2 << 8) + thisEvent.data3
+        if newTempo != 0:
+            lpSync.dwTempo = newTempo * SCALE
+    else:
+        if thisEvent.status == 0xF0:  # SYSEX
+            InsertInSysexBuffer(lpMO, thisEvent)
+        else:
+            dwMsg = thisEvent.status | (thisEvent.data1 << 8) | (thisEvent.data2 << 16)
+            lpMO.lpEncoder.Add(dwMsg)
+            TrackMidiOut(lpMO, dwMsg)
+
+#-----------------------------------------------------------------------------
+# ReadMidiOutEvents
+#
+# Removes every event queued in the output buffer of lpMO and returns them
+# as a MIDI_EVENT array, with the delta time of each event still in ticks.
+# The output buffer is left empty, so OUTBUFFER_READY is posted as it
+# drains past the 25% full mark, exactly as when sync() plays them out.
+#-----------------------------------------------------------------------------
+def ReadMidiOutEvents(lpMO):
+    return lpMO.lpMidiOutData.Pop()
+
+#-----------------------------------------------------------------------------
+# AllocMidiOutBuffer / AllocMidiInBuffer
+#
+# Give an output or input its event ring buffer. The output buffer posts
+# OUTBUFFER_READY to the output's window when it drains to 25% full. An
+# output also gets the note state used to turn off its sounding notes and
+# the encoder that packs its messages into one write per sync() call.
+#-----------------------------------------------------------------------------
+def AllocMidiOutBuffer(lpMO, nMidiOutSize):
+    lpMO.lpNoteState = NoteState()
+    lpMO.lpEncoder = MidiEncoder()
+    lpMO.lpMidiOutData = MidiEventRing(
+        nMidiOutSize, lambda: PostMessage(lpMO.hWnd, "OUTBUFFER_READY", 0, lpMO))
+    return lpMO.lpMidiOutData
+
+def AllocMidiInBuffer(lpMidiIn, nMidiInSize):
+    lpMidiIn.lpMidiInData = MidiEventRing(nMidiInSize)
+    return lpMidiIn.lpMidiInData
+
+#-----------------------------------------------------------------------------
+# SetSysexBuffers / AllocSysex / QueueSysex
+#
+# SysEx data is sent from a pool of nBuffers preallocated buffers of
+# nBufferSize bytes, nChunkSize bytes per output per sync interrupt.
+# SetSysexBuffers16 resizes the pool; it fails (returns 0) while any
+# buffer is in use.
+#
+# To send a message, AllocSysex16 a buffer for its length, write the
+# message (0xF0 ... 0xF7) into buffer.view and queue it with QueueSysex16
+# dwTime ticks after the previous event of the output. The buffer returns
+# to the pool once sent. AllocSysex16 returns None while all buffers are
+# in use.
+#-----------------------------------------------------------------------------
+def SetSysexBuffers16(hSync, nBuffers, nBufferSize, nChunkSize=128):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return 0
+
+    lpPool = hSync.lpSysexPool
+    if lpPool.NumFree() != len(lpPool.buffers):
+        return 0
+
+    hSync.lpSysexPool = SysexPool(midiOutLongMsg, nBuffers, nBufferSize, nChunkSize)
+    return 1
+
+def AllocSysex16(hSync, nLength):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return None
+
+    return hSync.lpSysexPool.Alloc(nLength)
+
+def QueueSysex16(hSync, lpMO, dwTime, lpBuf):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return 0
+
+    return hSync.lpSysexPool.Queue(lpMO, dwTime, lpBuf)
+
+#-----------------------------------------------------------------------------
+# AttachMidiOut / DetachMidiOut / SetMidiOutFlags
+#
+# Connect an output (with its buffer already allocated) to the sync
+# device, disconnect it, or change its flags. Outputs may be attached and
+# detached while sync is running; flags must be changed through
+# SetMidiOutFlags16 so the device sees which outputs get MIDI clock.
+#-----------------------------------------------------------------------------
+def AttachMidiOut16(hSync, lpMO):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return -1
+
+    lpMO.lpSync = hSync
+    return hSync.lpMidiOutList.Attach(lpMO)
+
+def DetachMidiOut16(hSync, lpMO):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return False
+
+    if not hSync.lpMidiOutList.Detach(lpMO):
+        return False
+    lpMO.lpSync = None
+    return True
+
+def SetMidiOutFlags16(hSync, lpMO, dwFlags):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return
+
+    hSync.lpMidiOutList.SetFlags(lpMO, dwFlags)
+
 #-----------------------------------------------------------------------------
 # sync handler
 #
@@ -541,21 +926,35 @@ def sync(lpSync):
             nticks = (lpSync.dwFticks + lpSync.dwTRtime) // lpSync.dwTempo
             lpSync.dwFticks += lpSync.dwTRtime - (nticks * lpSync.dwTempo)
             lpSync.wTempoTicks += nticks
+            lpSync.lpStats.nClockHolds += 1
             lpSync.wFlags &= ~0x10  # Clear IN_SYNC
             return
 
+        # Ticks the position may be off the clock count before it is
+        # corrected at once rather than through the tempo
+        nSlack = lpSync.lpClockTracker.Slack(lpSync.nTicksPerClock)
+
         if lpSync.wFlags & 0x40:  # Assuming MC_RESYNC is 0x40
-            lpSync.dwFticks = 0
             nticks = lpSync.nTicksPerClock - (lpSync.dwTicks - lpSync.dwLastTicks)
-            lpSync.dwLastTicks = lpSync.dwTicks + nticks
+            lpSync.dwLastTicks += lpSync.nTicksPerClock
             lpSync.wFlags &= ~0x40  # Clear MC_RESYNC
+            if nSlack and nticks <= nSlack:
+                # Within the slack, or ahead of the clock (the hold keeps
+                # that within the slack too): MidiClock bends the tempo to
+                # close it, so the fractional ticks are kept
+                nticks = 0
+            else:
+                lpSync.dwFticks = 0
+                if nticks > 1:
+                    # One tick is always left for the clock itself
+                    lpSync.lpStats.nClockCorrections += 1
         else:
             nticks = (lpSync.dwFticks + lpSync.dwTRtime) // lpSync.dwTempo
             lpSync.dwFticks += lpSync.dwTRtime - (nticks * lpSync.dwTempo)
             lpSync.wTempoTicks += nticks
 
-            if (lpSync.dwTicks - lpSync.dwLastTicks + nticks) >= lpSync.nTicksPerClock:
-                nticks = lpSync.nTicksPerClock - 1 - (lpSync.dwTicks - lpSync.dwLastTicks)
+            if (lpSync.dwTicks - lpSync.dwLastTicks + nticks) >= lpSync.nTicksPerClock + nSlack:
+                nticks = lpSync.nTicksPerClock + nSlack - 1 - (lpSync.dwTicks - lpSync.dwLastTicks)
                 lpSync.wFlags |= 0x20  # Set MC_HOLD
     else:
         nticks = (lpSync.dwFticks + lpSync.dwTRtime) // lpSync.dwTempo
@@ -565,8 +964,9 @@ def sync(lpSync):
     lpSync.dwTicks += nticks
     lpSync.nTicksSinceBeat += nticks
 
-    if lpSync.nTicksSinceBeat >= lpSync.wResolution:
-        PostMessage(lpSync.hWnd, "MIDI_BEAT", 0, ctypes.cast(lpSync, ctypes.c_void_p))
+    # A long timer period at a fast tempo can pass more than one beat
+    while lpSync.nTicksSinceBeat >= lpSync.wResolution:
+        PostMessage(lpSync.hWnd, "MIDI_BEAT", 0, lpSync)
         lpSync.nTicksSinceBeat -= lpSync.wResolution
 
     nclocks = 0
@@ -575,61 +975,54 @@ def sync(lpSync):
             nclocks += 1
             lpSync.nTicksSinceClock -= lpSync.nTicksPerClock
 
-    lpMOL = lpSync.lpMidiOutList
-    fDone = True
+    lpRegistry = lpSync.lpMidiOutList
+    written = []
 
-    while lpMOL and lpMOL.contents:
-        lpMO = lpMOL.contents
+    # nclocks is always 0 in S_MIDI mode. Clocks go ahead of the events.
+    if nclocks:
+        clocks = b"\xf8" * nclocks  # 0xF8 is MIDI_CLOCK
+        for lpMO in lpRegistry.Outputs(SYNC_OUTPUT):
+            lpMO.lpEncoder.AddRealTime(clocks)
+            written.append(lpMO)
 
-        nc = nclocks
-        if (lpMO.dwFlags & 0x08) and (lpSync.wSyncMode != "S_MIDI"):  # Assuming SYNC_OUTPUT is 0x08
-            while nc > 0:
-                midiOutShortMsg(lpMO.hMidiOut, 0xF8)  # 0xF8 is MIDI_CLOCK
-                nc -= 1
+    # Only outputs with an event due by now are looked at
+    for lpMO in lpRegistry.DueOutputs(lpSync.dwTicks):
+        lpRing = lpMO.lpMidiOutData
+        if lpRing.Span() != 0:
+            # Take every event due by now out of the buffer in one batch
+            events = lpRing.PeekDue(lpSync.dwTicks - lpMO.dwLastEventTicks)
+            nSent = 0
+            for thisEvent in map(MidiEvent._make, events.tolist()):
+                # Short messages are held back while a sysex is being sent
+                if (lpMO.dwFlags & SENDING_SYSEX) and (thisEvent.status != 0xF0):  # 0xF0 is SYSEX
+                    break
 
-        thisEvent = ctypes.cast(
-            ctypes.addressof(lpMO.lpMidiOutDataHead.contents) + lpMO.pMidiOutDataOut * ctypes.sizeof(lpMO.lpMidiOutDataHead.contents),
-            ctypes.POINTER(ctypes.c_void_p)
-        )
+                lpMO.dwLastEventTicks += thisEvent.time
 
-        if lpMO.wSpan != 0:
-            fDone = False
+                SendMidiOutEvent(lpSync, lpMO, thisEvent)
+                nSent += 1
 
-            while (thisEvent.contents.time <= lpSync.dwTicks - lpMO.dwLastEventTicks) and \
-                  (lpMO.wSpan != 0) and \
-                  ((lpMO.dwFlags & 0x100 == 0) or (thisEvent.contents.status == 0xF0)):  # Assuming SENDING_SYSEX is 0x100 and SYSEX is 0xF0
-                lpMO.dwLastEventTicks += thisEvent.contents.time
+            # Posts OUTBUFFER_READY if the buffer drained to 25% full
+            lpRing.Drop(nSent)
+            if nSent:
+                lpSync.lpStats.RecordEvents(lpMO, nSent)
 
-                if thisEvent.contents.status == 0:
-                    newTempo = (thisEvent.contents.data2 << 8) + thisEvent.contents.data3
-                    if newTempo != 0:
-                        lpSync.dwTempo = newTempo
-                else:
-                    if thisEvent.contents.status == 0xF0:  # SYSEX
-                        InsertInSysexBuffer(lpMO, thisEvent)
-                    else:
-                        dwMsg = thisEvent.contents.data1
-                        midiOutShortMsg(lpMO.hMidiOut, dwMsg)
-                        TrackMidiOut(lpMO, dwMsg)
+        written.append(lpMO)
+        lpRegistry.UpdateDue(lpMO)
 
-                lpMO.pMidiOutDataOut += 1
-                if lpMO.pMidiOutDataOut == lpMO.nMidiOutSize:
-                    lpMO.pMidiOutDataOut = 0
+    # One write per output for everything sent this tick (a flushed
+    # output has nothing left for a second flush)
+    for lpMO in written:
+        FlushMidiOut(lpMO)
 
-                if lpMO.wSpan == (lpMO.nMidiOutSize >> 2):
-                    PostMessage(lpMO.hWnd, "OUTBUFFER_READY", 0, ctypes.cast(lpMO, ctypes.c_void_p))
+    # Send the next chunk of any SysEx in progress
+    if lpSync.lpSysexPool.IsSending():
+        lpSync.lpSysexPool.Pump(lpSync)
 
-                lpMO.wSpan -= 1
-
-                thisEvent = ctypes.cast(
-                    ctypes.addressof(lpMO.lpMidiOutDataHead.contents) + lpMO.pMidiOutDataOut * ctypes.sizeof(lpMO.lpMidiOutDataHead.contents),
-                    ctypes.POINTER(ctypes.c_void_p)
-                )
-
-        lpMOL = ctypes.cast(ctypes.addressof(lpMOL.contents) + ctypes.sizeof(c_void_p), POINTER(c_void_p))
+    fDone = lpRegistry.AllEmpty()
 
     if fDone and (lpSync.nSysexBuffsActive == 0) and ((lpSync.wFlags & 0x08) == 0):  # Assuming SENT_SYNCDONE is 0x08
-        PostMessage(lpSync.hWnd, "SYNC_DONE", 0, ctypes.cast(lpSync, ctypes.c_void_p))
+        PostMessage(lpSync.hWnd, "SYNC_DONE", 0, lpSync)
         lpSync.wFlags |= 0x08  # Set SENT_SYNCDONE
 
     lpSync.wFlags &= ~0x10  # Clear IN_SYNC
@@ -642,22 +1035,115 @@ def sync(lpSync):
 # This callback processes the periodic timer events for internal sync
 # and serves as a timebase for midi sync.
 #
-# Parameter dwUser is lpSync.  Other parameters are unused.
+# Parameter dwUser is lpSync.  dw1 and dw2 are the deadline and the time
+# the timer actually fired, in monotonic nS, and are used to record the
+# timer lateness.  Other parameters are unused.
 #-----------------------------------------------------------------------------
 def syncTimer(wTimerID, wMsg, dwUser, dw1, dw2):
     # Don't call sync if already servicing a MIDI clock event
-    lpSync = ctypes.cast(dwUser, ctypes.POINTER(SyncStruct)).contents
+    lpSync = dwUser
+    lpStats = lpSync.lpStats
+    lpStats.nTimerCalls += 1
+    lpStats.lateness.Record(max(0, dw2 - dw1))
+
     IN_SYNC = 0x10  # Assuming IN_SYNC is defined as 0x10
     if (lpSync.wFlags & IN_SYNC) == 0:
+        nsStart = time.perf_counter_ns()
         sync(lpSync)
+        lpStats.cost.Record(time.perf_counter_ns() - nsStart)
+    else:
+        lpStats.nSkipped += 1
+#-----------------------------------------------------------------------------
+# syncBlockTimer callback function
+#
+# Timer callback for block mode. Each wakeup runs sync() once for every
+# wTimerPeriod of real time that has passed since the last wakeup,
+# measured from the monotonic time the timer fired (dw2), so a late
+# wakeup catches up on the periods it missed instead of losing them.
+# Each of those sync() calls sees its own msPosition, so events, MIDI
+# clocks and MIDI_BEAT messages in the block keep their place in time.
+# The remainder of a partial period is carried to the next wakeup.
+#-----------------------------------------------------------------------------
+def syncBlockTimer(wTimerID, wMsg, dwUser, dw1, dw2):
+    lpSync = dwUser
+    lpStats = lpSync.lpStats
+    lpStats.nTimerCalls += 1
+    lpStats.lateness.Record(max(0, dw2 - dw1))
+
+    nsPeriod = lpSync.wTimerPeriod * 1000000
+    if lpSync.nsBlockLast is None:
+        lpSync.nsBlockLast = dw1 - lpSync.wBlockPeriod * 1000000
+
+    # While stopped there is no time to catch up on
+    if (lpSync.wFlags & SYNC_RUNNING) != SYNC_RUNNING:
+        lpSync.nsBlockLast = dw2
+        return
+
+    IN_SYNC = 0x10  # Assuming IN_SYNC is defined as 0x10
+    if lpSync.wFlags & IN_SYNC:
+        # The periods stay owed to the next wakeup
+        lpStats.nSkipped += 1
+        return
+
+    nSteps = (dw2 - lpSync.nsBlockLast) // nsPeriod
+    lpSync.nsBlockLast += nSteps * nsPeriod
+
+    nsStart = time.perf_counter_ns()
+    for _ in range(nSteps):
+        sync(lpSync)
+    lpStats.cost.Record(time.perf_counter_ns() - nsStart)
+
+#-----------------------------------------------------------------------------
+# SetBlockMode
+#
+# wBlockPeriod non-zero switches internal sync to block mode: the timer
+# wakes every wBlockPeriod mS and syncBlockTimer services the real time
+# passed since the previous wakeup, wTimerPeriod mS at a time. Timing
+# resolution stays at wTimerPeriod while wakeups are wBlockPeriod apart,
+# and a wakeup that comes late still sends everything at its position.
+# wBlockPeriod zero returns to one sync() per wTimerPeriod interrupt.
+#
+# returns 0 if successful, TIMERR_NOCANDO if the timer can not be set
+# or a lookahead scheduler is dispatching (close it first)
+#-----------------------------------------------------------------------------
+def SetBlockMode16(hSync, wBlockPeriod):
+    # If not open, ignore request
+    if hSync is None or hSync <= MXMIDIERR_MAXERR:
+        return TIMERR_NOCANDO
+
+    lpSync = hSync
+    if lpSync.lpScheduler is not None:
+        return TIMERR_NOCANDO
+
+    # Stop the current timer
+    if lpSync.wTimerID is not None:
+        timeKillEvent(lpSync.wTimerID)
+        lpSync.wTimerID = None
+
+    lpSync.wBlockPeriod = wBlockPeriod
+    lpSync.nsBlockLast = None
+
+    if wBlockPeriod:
+        lpSync.wTimerID = timeSetEvent(wBlockPeriod, lpSync.wTimerPeriod, syncBlockTimer, lpSync, TIME_PERIODIC)
+    else:
+        lpSync.wTimerID = timeSetEvent(lpSync.wTimerPeriod, lpSync.wTimerPeriod, syncTimer, lpSync, TIME_PERIODIC)
+
+    if lpSync.wTimerID is None:
+        return TIMERR_NOCANDO
+    return TIMERR_NOERROR
+
 #-----------------------------------------------------------------------------
 # midi sync handler
 #
 # This function is called when the sync in device receives a midi clock
-# message.  It calculates a new tempo based on the number of ticks since
-# the last clock.
+# message.  It calculates a new tempo from the arrival times of the
+# recent clocks (see clock_tracker), falling back to the number of ticks
+# since the last clock until two clocks have been seen.
+#
+# nsTime is the monotonic time the clock was received in nS, now if not
+# given.
 #-----------------------------------------------------------------------------
-def MidiClock(lpSync):
+def MidiClock(lpSync, nsTime=None):
     # Next sync() will be a re-sync
     MC_RESYNC = 0x40  # Assuming MC_RESYNC is defined as 0x40
     lpSync.wFlags |= MC_RESYNC
@@ -670,8 +1156,18 @@ def MidiClock(lpSync):
     sync(lpSync)
 
     # Calculate new tempo
-    lpSync.dwTempo -= ((lpSync.nTicksPerClock - lpSync.wTempoTicks) *
-                       (lpSync.dwTempo // lpSync.wResolution))
+    if nsTime is None:
+        nsTime = time.monotonic_ns()
+    lpClockTracker = lpSync.lpClockTracker
+    uSPerBeat = lpClockTracker.Clock(nsTime)
+    if uSPerBeat is not None:
+        # Pull a position left off the clock count (fractional ticks
+        # included) back in over the next few clocks
+        fBehind = lpSync.dwLastTicks - lpSync.dwTicks - lpSync.dwFticks / float(lpSync.dwTempo)
+        lpSync.dwTempo = int(uSPerBeat * lpClockTracker.Bend(fBehind, lpSync.nTicksPerClock) * SCALE)
+    else:
+        lpSync.dwTempo -= ((lpSync.nTicksPerClock - lpSync.wTempoTicks) *
+                           (lpSync.dwTempo // lpSync.wResolution))
 
     # Clear tempo tick count
     lpSync.wTempoTicks = 0
\ No newline at end of file
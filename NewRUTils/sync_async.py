@@ -0,0 +1,150 @@
+import asyncio
+import threading
+
+from ring_buffer import MidiEvent
+from sync import SENT_SYNCDONE
+
+
+#-----------------------------------------------------------------------------
+# asyncio sync notifications
+#
+# SyncNotifier stands in for the hWnd of a sync device, its outputs and
+# its sync input: PostMessage calls it from the timer thread with
+# MIDI_BEAT, OUTBUFFER_READY, SYNC_DONE and MIDI_DATA. The messages are
+# queued and handed to the event loop in batches, with one
+# call_soon_threadsafe per batch rather than per message, where they
+# complete the coroutines waiting on them:
+#
+#   notifier = SyncNotifier()
+#   hSync = OpenSync16(0, notifier, "S_INT", 1)
+#   lpMO.hWnd = notifier
+#
+#   async def feeder(lpMO, chunks):
+#       for chunk in chunks:
+#           lpMO.lpMidiOutData.Push(chunk)
+#           await notifier.WaitBufferReady(lpMO)
+#
+#   async for event in notifier.MidiData():
+#       ...
+#
+# Waits complete on the next matching message after the call. Messages
+# nobody is waiting for are dropped, except for MIDI_DATA: the incoming
+# events stay in the input buffer until the iterator reads them, and
+# SYNC_DONE: it is latched, so WaitDone returns at once while the device
+# that sent it is still done. Starting the device again clears its
+# SENT_SYNCDONE flag, and with it the latch.
+#
+# Reading the input buffer empties it, so a notifier has at most one
+# MidiData iterator at a time; starting a second raises RuntimeError.
+#-----------------------------------------------------------------------------
+
+class SyncNotifier:
+    def __init__(self, loop=None, hWnd=None):
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.hWnd = hWnd                # also receives every message, if callable
+        self.nBeats = 0
+        self.lpDone = None              # device of the last SYNC_DONE
+        self.pending = []               # (msg, wParam, lParam) from the timer thread
+        self.pendingLock = threading.Lock()
+        self.waiters = {}               # msg -> [(future, lParam or None)]
+        self.dataQueue = None           # lpMidiIn queue of the MidiData iterator
+
+    #-------------------------------------------------------------------------
+    # __call__
+    # Called by PostMessage, from any thread. Only the first message of a
+    # batch schedules a delivery on the loop.
+    #-------------------------------------------------------------------------
+    def __call__(self, msg, wParam, lParam):
+        with self.pendingLock:
+            self.pending.append((msg, wParam, lParam))
+            if len(self.pending) > 1:
+                return
+
+        try:
+            self.loop.call_soon_threadsafe(self._Deliver)
+        except RuntimeError:
+            # The loop is closed, nobody is left to notify
+            with self.pendingLock:
+                self.pending.clear()
+
+    def _Deliver(self):
+        with self.pendingLock:
+            batch, self.pending = self.pending, []
+
+        midiIns = []
+        for msg, wParam, lParam in batch:
+            if msg == "MIDI_BEAT":
+                self.nBeats += 1
+                self._Wake(msg, lParam, self.nBeats)
+            elif msg == "MIDI_DATA":
+                if lParam not in midiIns:
+                    midiIns.append(lParam)
+            elif msg == "SYNC_DONE":
+                self.lpDone = lParam
+                self._Wake(msg, lParam, lParam)
+            else:
+                self._Wake(msg, lParam, lParam)
+
+            if callable(self.hWnd):
+                self.hWnd(msg, wParam, lParam)
+
+        if self.dataQueue is not None:
+            for lpMidiIn in midiIns:
+                self.dataQueue.put_nowait(lpMidiIn)
+
+    def _Wake(self, msg, lParam, result):
+        waiters = self.waiters.get(msg)
+        if not waiters:
+            return
+
+        remaining = []
+        for future, lpFilter in waiters:
+            if future.done():
+                continue
+            if lpFilter is None or lpFilter is lParam:
+                future.set_result(result)
+            else:
+                remaining.append((future, lpFilter))
+        self.waiters[msg] = remaining
+
+    def _Wait(self, msg, lpFilter=None):
+        future = self.loop.create_future()
+        self.waiters.setdefault(msg, []).append((future, lpFilter))
+        return future
+
+    #-------------------------------------------------------------------------
+    # WaitBeat / WaitBufferReady / WaitDone
+    # WaitBeat returns the number of beats seen so far, WaitBufferReady the
+    # output whose buffer drained to 25% full (only lpMO, if given) and
+    # WaitDone the sync handle, at once if it is done already.
+    #-------------------------------------------------------------------------
+    async def WaitBeat(self):
+        return await self._Wait("MIDI_BEAT")
+
+    async def WaitBufferReady(self, lpMO=None):
+        return await self._Wait("OUTBUFFER_READY", lpMO)
+
+    async def WaitDone(self):
+        lpDone = self.lpDone
+        if lpDone is not None and lpDone.wFlags & SENT_SYNCDONE:
+            return lpDone
+        return await self._Wait("SYNC_DONE")
+
+    #-------------------------------------------------------------------------
+    # MidiData
+    # Yields the events recorded by the sync inputs (tempo changes pushed
+    # by SetTempo16 and incoming MIDI) as MidiEvent tuples, each MIDI_DATA
+    # batch popped from the input buffer in one go. Only one iterator may
+    # run at a time, since each batch can be popped only once.
+    #-------------------------------------------------------------------------
+    async def MidiData(self):
+        if self.dataQueue is not None:
+            raise RuntimeError("SyncNotifier already has a MidiData iterator")
+        queue = self.dataQueue = asyncio.Queue()
+        try:
+            while True:
+                lpMidiIn = await queue.get()
+                for event in lpMidiIn.lpMidiInData.Pop().tolist():
+                    yield MidiEvent._make(event)
+        finally:
+            self.dataQueue = None
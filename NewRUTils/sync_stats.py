@@ -0,0 +1,88 @@
+import bisect
+
+
+#-----------------------------------------------------------------------------
+# Sync loop instrumentation
+#
+# Counters kept on every sync handle (lpSync.lpStats) so wTimerPeriod and
+# buffer sizes can be tuned from measurements:
+#
+#   timer lateness  how late each syncTimer call ran after its deadline
+#   sync cost       how long each sync() call took
+#   events per tick how many events each output sent in one sync() call
+#   skipped ticks   timer calls dropped because IN_SYNC was still set
+#   clock holds     S_MIDI timer ticks spent waiting for a late clock
+#   corrections     S_MIDI clocks that came before their ticks were
+#                   generated, so the missing ticks were added at once
+#
+# Latencies go into fixed-bucket histograms (bucket upper bounds in uS),
+# so recording is a bisect and an increment. Use GetSyncStats16 to read a
+# snapshot and ResetSyncStats16 to clear the counters while running.
+#-----------------------------------------------------------------------------
+
+LATENCY_BUCKETS_US = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000]
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS_US):
+        self.buckets = buckets
+        self.Reset()
+
+    def Reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)    # last bucket is overflow
+        self.nCount = 0
+        self.nsTotal = 0
+        self.nsMax = 0
+
+    def Record(self, ns):
+        self.counts[bisect.bisect_left(self.buckets, ns // 1000)] += 1
+        self.nCount += 1
+        self.nsTotal += ns
+        if ns > self.nsMax:
+            self.nsMax = ns
+
+    def Snapshot(self):
+        return {
+            "count": self.nCount,
+            "mean_us": self.nsTotal / self.nCount / 1000 if self.nCount else 0.0,
+            "max_us": self.nsMax / 1000,
+            "buckets_us": list(self.buckets),
+            "counts": list(self.counts),
+        }
+
+
+class SyncStats:
+    def __init__(self):
+        self.lateness = LatencyHistogram()
+        self.cost = LatencyHistogram()
+        self.Reset()
+
+    def Reset(self):
+        self.lateness.Reset()
+        self.cost.Reset()
+        self.nTimerCalls = 0
+        self.nSkipped = 0
+        self.nClockHolds = 0
+        self.nClockCorrections = 0
+        self.outputs = {}       # lpMO -> [events sent, ticks with events, max events in a tick]
+
+    def RecordEvents(self, lpMO, nSent):
+        counts = self.outputs.get(lpMO)
+        if counts is None:
+            counts = self.outputs[lpMO] = [0, 0, 0]
+        counts[0] += nSent
+        counts[1] += 1
+        if nSent > counts[2]:
+            counts[2] = nSent
+
+    def Snapshot(self):
+        return {
+            "timer_calls": self.nTimerCalls,
+            "skipped": self.nSkipped,
+            "clock_holds": self.nClockHolds,
+            "clock_corrections": self.nClockCorrections,
+            "lateness": self.lateness.Snapshot(),
+            "sync_cost": self.cost.Snapshot(),
+            "outputs": [{"output": lpMO, "events": counts[0], "ticks": counts[1], "max_per_tick": counts[2]}
+                        for lpMO, counts in self.outputs.items()],
+        }
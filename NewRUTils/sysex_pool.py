@@ -0,0 +1,154 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+
+#-----------------------------------------------------------------------------
+# SysEx buffer pool
+#
+# SysEx messages do not fit in the 5 byte records of the output buffers, so
+# their data is kept in a pool of buffers allocated once when the sync
+# device is opened. A message is written straight into a free buffer
+# through its memoryview and queued in the output buffer as a SYSEX event
+# (status 0xF0) carrying the buffer number in data1/data2.
+#
+# When sync() reaches the event, InsertInSysexBuffer starts sending the
+# buffer: SENDING_SYSEX is set on the output, holding back its short
+# messages, and lpSync.nSysexBuffsActive counts the buffer until its last
+# chunk is out, holding back SYNC_DONE. Each sync() call then sends at
+# most nChunkSize bytes per output, as memoryview slices of the buffer,
+# so a large dump is spread over many ticks rather than stalling one.
+# Finished buffers go back on the free list.
+#-----------------------------------------------------------------------------
+
+# MIDI out flags (dwFlags)
+SENDING_SYSEX = 0x100
+
+
+class SysexBuffer:
+    __slots__ = ("nIndex", "data", "view", "nLength", "nSent")
+
+    def __init__(self, nIndex, nBufferSize):
+        self.nIndex = nIndex
+        self.data = bytearray(nBufferSize)
+        self.view = memoryview(self.data)
+        self.nLength = 0
+        self.nSent = 0
+
+
+class SysexPool:
+    def __init__(self, lpfnSend, nBuffers=16, nBufferSize=4096, nChunkSize=128):
+        self.lpfnSend = lpfnSend        # midiOutLongMsg(hMidiOut, data)
+        self.nBufferSize = nBufferSize
+        self.nChunkSize = nChunkSize
+        self.buffers = [SysexBuffer(nIndex, nBufferSize) for nIndex in range(nBuffers)]
+        self.freeBuffers = list(range(nBuffers))
+        self.freeLock = threading.Lock()    # Alloc runs on the producer's thread
+        self.active = {}                # lpMO -> deque of buffers being sent
+
+    #-------------------------------------------------------------------------
+    # Alloc
+    # Takes a free buffer for a message of nLength bytes (including the
+    # 0xF0 and 0xF7). Fill buffer.view[:nLength] and pass the buffer to
+    # Queue. Returns None if the message is too long or no buffer is free.
+    #-------------------------------------------------------------------------
+    def Alloc(self, nLength):
+        if nLength > self.nBufferSize:
+            return None
+
+        with self.freeLock:
+            if not self.freeBuffers:
+                return None
+            lpBuf = self.buffers[self.freeBuffers.pop()]
+
+        lpBuf.nLength = nLength
+        lpBuf.nSent = 0
+        return lpBuf
+
+    def Release(self, lpBuf):
+        with self.freeLock:
+            self.freeBuffers.append(lpBuf.nIndex)
+
+    def NumFree(self):
+        return len(self.freeBuffers)
+
+    #-------------------------------------------------------------------------
+    # Queue
+    # Appends the SYSEX event for a filled buffer to the output buffer of
+    # lpMO, dwTime ticks after the previous event. Returns 0 and frees the
+    # buffer if the output buffer is full.
+    #-------------------------------------------------------------------------
+    def Queue(self, lpMO, dwTime, lpBuf):
+        nIndex = lpBuf.nIndex
+        if lpMO.lpMidiOutData.PushEvent(dwTime, 0xF0, nIndex >> 8, nIndex & 0xFF) == 0:
+            self.Release(lpBuf)
+            return 0
+        return 1
+
+    #-------------------------------------------------------------------------
+    # Insert
+    # Starts sending the buffer named by a SYSEX event taken out of the
+    # output buffer of lpMO. Buffers inserted while one is being sent are
+    # sent after it, in order.
+    #-------------------------------------------------------------------------
+    def Insert(self, lpSync, lpMO, thisEvent):
+        lpBuf = self.buffers[(thisEvent.data1 << 8) | thisEvent.data2]
+
+        queue = self.active.get(lpMO)
+        if queue is None:
+            queue = self.active[lpMO] = deque()
+        queue.append(lpBuf)
+
+        lpMO.dwFlags |= SENDING_SYSEX
+        lpSync.nSysexBuffsActive += 1
+
+    #-------------------------------------------------------------------------
+    # Pump
+    # Sends the next chunk of the current buffer of every output that is
+    # sending SysEx. Called once per sync() call.
+    #-------------------------------------------------------------------------
+    def Pump(self, lpSync):
+        for lpMO in list(self.active):
+            queue = self.active[lpMO]
+            lpBuf = queue[0]
+
+            nEnd = min(lpBuf.nSent + self.nChunkSize, lpBuf.nLength)
+            self.lpfnSend(lpMO.hMidiOut, lpBuf.view[lpBuf.nSent:nEnd])
+            lpBuf.nSent = nEnd
+
+            if nEnd == lpBuf.nLength:
+                queue.popleft()
+                self.Release(lpBuf)
+                lpSync.nSysexBuffsActive -= 1
+                if not queue:
+                    del self.active[lpMO]
+                    lpMO.dwFlags &= ~SENDING_SYSEX
+
+    def IsSending(self):
+        return bool(self.active)
+
+    #-------------------------------------------------------------------------
+    # Abort
+    # Drops the buffers being sent to lpMO, as midiOutReset does.
+    #-------------------------------------------------------------------------
+    def Abort(self, lpSync, lpMO):
+        queue = self.active.pop(lpMO, None)
+        if queue is None:
+            return
+
+        for lpBuf in queue:
+            self.Release(lpBuf)
+        lpSync.nSysexBuffsActive -= len(queue)
+        lpMO.dwFlags &= ~SENDING_SYSEX
+
+    #-------------------------------------------------------------------------
+    # ReleaseEvents
+    # Frees the buffers of the SYSEX events in a MIDI_EVENT array of events
+    # dropped from an output buffer without being sent.
+    #-------------------------------------------------------------------------
+    def ReleaseEvents(self, events):
+        sysex = events[events["status"] == 0xF0]
+        nIndexes = (sysex["data1"].astype(np.int64) << 8) | sysex["data2"]
+        for nIndex in nIndexes.tolist():
+            self.Release(self.buffers[nIndex])
@@ -0,0 +1,129 @@
+import bisect
+
+import numpy as np
+
+
+#-----------------------------------------------------------------------------
+# Tempo map
+#
+# Index of the tempo changes in a loaded sequence as piecewise constant
+# segments. Each segment holds its starting tick, its starting position in
+# ms (accumulated over all earlier segments) and its tempo in uS per beat,
+# so converting a tick to ms (or back) is a bisect plus one multiply.
+#
+# Built from the tempo events (status 0) queued in the output buffers, the
+# map lets StartSync16 start from any position by computing the ms
+# position and tempo there instead of replaying the song from tick 0.
+# The map remembers the outputs and the events pushed to them when it was
+# built (its source); once a new sequence is loaded the source no longer
+# matches and StartSync16 builds the map again.
+#-----------------------------------------------------------------------------
+
+class TempoMap:
+    def __init__(self, wResolution, uSPerBeat=500000):
+        self.wResolution = wResolution
+        self.dwTicks = [0]              # segment start, ticks
+        self.ms = [0.0]                 # segment start, ms
+        self.uSPerBeat = [uSPerBeat]    # segment tempo
+        self.source = None              # TempoMapSource when built
+
+    #-------------------------------------------------------------------------
+    # AddTempo
+    # Starts a new segment at dwTicks. Tempo changes must be added in tick
+    # order; a change at the same tick as the last one replaces it.
+    #-------------------------------------------------------------------------
+    def AddTempo(self, dwTicks, uSPerBeat):
+        if dwTicks < self.dwTicks[-1]:
+            raise ValueError(f"Tempo change at tick {dwTicks} is before tick {self.dwTicks[-1]}")
+
+        if dwTicks == self.dwTicks[-1]:
+            self.uSPerBeat[-1] = uSPerBeat
+            return
+
+        ms = self.ms[-1] + (dwTicks - self.dwTicks[-1]) * self.uSPerBeat[-1] / (self.wResolution * 1000.0)
+        self.dwTicks.append(dwTicks)
+        self.ms.append(ms)
+        self.uSPerBeat.append(uSPerBeat)
+
+    def TempoAt(self, dwTicks):
+        return self.uSPerBeat[bisect.bisect_right(self.dwTicks, dwTicks) - 1]
+
+    def TicksToMs(self, dwTicks):
+        i = bisect.bisect_right(self.dwTicks, dwTicks) - 1
+        return self.ms[i] + (dwTicks - self.dwTicks[i]) * self.uSPerBeat[i] / (self.wResolution * 1000.0)
+
+    def MsToTicks(self, ms):
+        i = bisect.bisect_right(self.ms, ms) - 1
+        return self.dwTicks[i] + int((ms - self.ms[i]) * self.wResolution * 1000.0 / self.uSPerBeat[i])
+
+
+#-----------------------------------------------------------------------------
+# FindTempos
+#
+# Returns the tempo events in a MIDI_EVENT array whose delta times start
+# at tick dwStartTicks, as (dwTicks, uSPerBeat) pairs in tick order.
+#-----------------------------------------------------------------------------
+def FindTempos(events, dwStartTicks=0):
+    isTempo = events["status"] == 0
+    dwTicks = dwStartTicks + np.cumsum(events["time"], dtype=np.int64)
+    tempos = events[isTempo]
+    uSPerBeat = ((tempos["data1"].astype(np.int64) << 16) |
+                 (tempos["data2"].astype(np.int64) << 8) |
+                 tempos["data3"].astype(np.int64))
+    found = zip(dwTicks[isTempo].tolist(), uSPerBeat.tolist())
+    return [(dwTicks, uS) for dwTicks, uS in found if uS != 0]
+
+
+#-----------------------------------------------------------------------------
+# TempoMapSource
+#
+# Identifies what a tempo map is built from: the resolution and each
+# output's buffer with its count of events pushed so far. Playing events
+# out leaves it unchanged; loading events, attaching or detaching an
+# output or changing the resolution changes it.
+#-----------------------------------------------------------------------------
+def TempoMapSource(lpSync, lpMidiOutList):
+    return (lpSync.wResolution,
+            tuple((id(lpMO.lpMidiOutData), lpMO.lpMidiOutData.nIn) for lpMO in lpMidiOutList))
+
+
+#-----------------------------------------------------------------------------
+# BuildTempoMap
+#
+# Builds the tempo map for a sequence queued from tick 0 in the given
+# outputs, starting at tempo uSPerBeat, and stores it in lpSync.lpTempoMap.
+# Events stay in the output buffers.
+#-----------------------------------------------------------------------------
+def BuildTempoMap(lpSync, uSPerBeat, lpMidiOutList):
+    lpTempoMap = TempoMap(lpSync.wResolution, uSPerBeat)
+
+    tempos = []
+    for lpMO in lpMidiOutList:
+        tempos.extend(FindTempos(lpMO.lpMidiOutData.Peek()))
+
+    for dwTicks, uS in sorted(tempos, key=lambda tempo: tempo[0]):
+        lpTempoMap.AddTempo(dwTicks, uS)
+
+    lpTempoMap.source = TempoMapSource(lpSync, lpMidiOutList)
+    lpSync.lpTempoMap = lpTempoMap
+    return lpTempoMap
+
+
+#-----------------------------------------------------------------------------
+# SkipMidiOutEvents
+#
+# Drops the events queued in lpMO that fall before dwStartTicks, leaving
+# dwLastEventTicks at the last dropped event so the delta time of the
+# first remaining event still lands on the right tick. Returns the
+# dropped events.
+#-----------------------------------------------------------------------------
+def SkipMidiOutEvents(lpMO, dwStartTicks):
+    lpRing = lpMO.lpMidiOutData
+    events = lpRing.Peek()
+    dwTicks = lpMO.dwLastEventTicks + np.cumsum(events["time"], dtype=np.int64)
+
+    nSkip = int(np.searchsorted(dwTicks, dwStartTicks, side="left"))
+    if nSkip:
+        lpMO.dwLastEventTicks = int(dwTicks[nSkip - 1])
+        lpRing.Drop(nSkip)
+    return events[:nSkip]
@@ -0,0 +1,261 @@
+import json
+import os
+
+import numpy as np
+
+from song_codec import HASH_NAME
+
+
+#////////////////////////////////////////////////////////////////////////
+#///////////////////// UNIQUE STORE /////////////////////////////////////
+#////////////////////////////////////////////////////////////////////////
+
+# Disk-backed set of 64-bit song hashes, for runs far larger than a
+# Python set can hold in RAM.
+#
+# The store is split into n_shards shards by the top bits of the hash.
+# Each shard is an open-addressing (linear probing) table of
+# fingerprints in its own memory-mapped file, so only the pages being
+# probed need to be in memory and the OS pages the rest to disk. A
+# fingerprint of fp_bits bits is kept per song instead of the hash:
+#
+#   fp_bits 64  exact (the hash itself)                 8 bytes per slot
+#   fp_bits 32  false positive rate ~ 2e-9 at 0.8 load  4 bytes per slot
+#   fp_bits 16  false positive rate ~ 2e-4 at 0.8 load  2 bytes per slot
+#
+# A false positive drops a new song as a duplicate; it never lets a
+# duplicate through. Pass fp_rate instead of fp_bits to get the smallest
+# fingerprint meeting that rate at max_load.
+#
+# The tables do not grow: capacity (songs) sizes them when the store is
+# created. Sharding keeps a lookup to one small table and lets the
+# lookups of a batch run shard by shard, vectorized with numpy.
+#
+# The store has a single writer. Producers open it read-only to drop
+# songs already stored before they are queued (a pre-filter: a song
+# added after the check still reaches the writer, which has the final
+# say).
+#
+# store.json records the song_codec HASH_NAME of the stored hashes; a
+# store made with another hash is refused.
+
+FP_DTYPES = {16: np.uint16, 32: np.uint32, 64: np.uint64}
+FP_MIX = np.uint64(0x9E3779B97F4A7C15)
+META_NAME = "store.json"
+COUNTS_NAME = "counts.bin"
+
+
+# Expected false positive rate for a new song: the fingerprints compared
+# along an unsuccessful linear probe, each matching with 1 / 2^fp_bits
+def false_positive_rate(fp_bits, load):
+    if fp_bits >= 64:
+        return 0.0
+    probes = 0.5 * (1 + 1 / (1 - load) ** 2)
+    return probes * load / 2.0 ** fp_bits
+
+
+class UniqueStore:
+    def __init__(self, path, capacity=None, n_shards=256, fp_bits=None, fp_rate=1e-8,
+                 max_load=0.8, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        meta_path = os.path.join(path, META_NAME)
+
+        if os.path.exists(meta_path):
+            with open(meta_path) as meta_file:
+                meta = json.load(meta_file)
+            if meta.get("hash") != HASH_NAME:
+                raise ValueError(f"Unique store {path} holds {meta.get('hash')} hashes, not {HASH_NAME}")
+        else:
+            if readonly or capacity is None:
+                raise FileNotFoundError(f"No unique store at {path}")
+            meta = self._create(path, capacity, n_shards, fp_bits, fp_rate, max_load)
+
+        self.meta = meta
+        self.n_shards = meta["shards"]
+        self.shard_bits = self.n_shards.bit_length() - 1
+        self.slots = meta["slots"]
+        self.slot_mask = self.slots - 1
+        self.fp_bits = meta["fp_bits"]
+        self.max_load = meta["max_load"]
+        dtype = FP_DTYPES[self.fp_bits]
+
+        mode = "r" if readonly else "r+"
+        self.tables = [np.memmap(os.path.join(path, f"shard-{shard:04x}.bin"), dtype=dtype, mode=mode,
+                                 shape=(self.slots,)) for shard in range(self.n_shards)]
+        self.counts = np.memmap(os.path.join(path, COUNTS_NAME), dtype=np.int64, mode=mode,
+                                shape=(self.n_shards,))
+
+        # Probe statistics of this session
+        self.lookups = 0
+        self.probes = 0
+        self.max_probes = 0
+
+    @staticmethod
+    def _create(path, capacity, n_shards, fp_bits, fp_rate, max_load):
+        if n_shards < 1 or n_shards & (n_shards - 1):
+            raise ValueError(f"n_shards must be a power of two, not {n_shards}")
+        if fp_bits is None:
+            fp_bits = next((bits for bits in sorted(FP_DTYPES)
+                            if false_positive_rate(bits, max_load) <= fp_rate), 64)
+        elif fp_bits not in FP_DTYPES:
+            raise ValueError(f"fp_bits must be one of {sorted(FP_DTYPES)}, not {fp_bits}")
+
+        per_shard = max(1, int(capacity / n_shards / max_load))
+        slots = 1 << (per_shard - 1).bit_length()
+        meta = {"shards": n_shards, "slots": slots, "fp_bits": fp_bits, "max_load": max_load,
+                "capacity": capacity, "hash": HASH_NAME}
+
+        os.makedirs(path, exist_ok=True)
+        size = slots * FP_DTYPES[fp_bits]().itemsize
+        for shard in range(n_shards):
+            # Sparse files: disk is only used as slots fill
+            with open(os.path.join(path, f"shard-{shard:04x}.bin"), "wb") as shard_file:
+                shard_file.truncate(size)
+        with open(os.path.join(path, COUNTS_NAME), "wb") as counts_file:
+            counts_file.truncate(n_shards * 8)
+        with open(os.path.join(path, META_NAME), "w") as meta_file:
+            json.dump(meta, meta_file, indent=2)
+        return meta
+
+    # Split hashes into shard, home slot and fingerprint. The fingerprint
+    # comes from a multiplicative mix so it does not repeat the bits used
+    # for the shard and slot; 0 marks an empty slot and is mapped to 1.
+    def _split(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        if self.shard_bits:
+            shards = (hashes >> np.uint64(64 - self.shard_bits)).astype(np.intp)
+        else:
+            shards = np.zeros(len(hashes), dtype=np.intp)
+        homes = (hashes & np.uint64(self.slot_mask)).astype(np.intp)
+        if self.fp_bits == 64:
+            fps = hashes.copy()
+        else:
+            fps = ((hashes * FP_MIX) >> np.uint64(64 - self.fp_bits)).astype(FP_DTYPES[self.fp_bits])
+        fps[fps == 0] = 1
+        return shards, homes, fps
+
+    # Run fn(shard, homes, fps) -> bool array for every shard in the
+    # batch and put the results back in batch order
+    def _by_shard(self, hashes, fn):
+        shards, homes, fps = self._split(hashes)
+        result = np.zeros(len(fps), dtype=bool)
+        if not len(fps):
+            return result
+        order = np.argsort(shards, kind="stable")
+        bounds = np.searchsorted(shards[order], np.arange(self.n_shards + 1))
+        for shard in np.flatnonzero(np.diff(bounds)):
+            idx = order[bounds[shard]:bounds[shard + 1]]
+            result[idx] = fn(shard, homes[idx], fps[idx])
+        self.lookups += len(fps)
+        return result
+
+    def _probe(self, shard, homes, fps, insert):
+        table = self.tables[shard]
+        found = np.zeros(len(fps), dtype=bool)
+        added = np.zeros(len(fps), dtype=bool)
+        pos = homes.copy()
+        pending = np.arange(len(fps))
+        steps = 0
+
+        while pending.size:
+            steps += 1
+            if steps > self.slots:
+                raise RuntimeError(f"Unique store shard {shard} is full; create it with a larger capacity")
+            slot = pos[pending]
+            values = table[slot]
+            self.probes += pending.size
+
+            hit = values == fps[pending]
+            empty = values == 0
+            found[pending[hit]] = True
+
+            retry = np.zeros(0, dtype=pending.dtype)
+            if insert and empty.any():
+                # Several songs of the batch may want the same empty slot:
+                # the first takes it and the others look at it again next
+                # round (an identical song then finds itself)
+                claim = pending[empty]
+                slots_claimed, first = np.unique(slot[empty], return_index=True)
+                table[slots_claimed] = fps[claim[first]]
+                added[claim[first]] = True
+                lost = np.ones(len(claim), dtype=bool)
+                lost[first] = False
+                retry = claim[lost]
+
+            moving = pending[~hit & ~empty]
+            pos[moving] = (pos[moving] + 1) & self.slot_mask
+            pending = np.concatenate((moving, retry))
+
+        self.max_probes = max(self.max_probes, steps)
+        if insert:
+            self.counts[shard] += int(added.sum())
+            return added
+        return found
+
+    # Adds a batch of hashes; returns a bool array, True for each hash
+    # that was new (the first of any repeats within the batch)
+    def add_batch(self, hashes):
+        if self.readonly:
+            raise PermissionError("Unique store is open read-only")
+        return self._by_shard(hashes, lambda shard, homes, fps: self._probe(shard, homes, fps, True))
+
+    # Returns a bool array, True for each hash already in the store
+    def contains_batch(self, hashes):
+        return self._by_shard(hashes, lambda shard, homes, fps: self._probe(shard, homes, fps, False))
+
+    def add(self, song_hash):
+        return bool(self.add_batch([song_hash])[0])
+
+    def __contains__(self, song_hash):
+        return bool(self.contains_batch([song_hash])[0])
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def stats(self):
+        loads = np.asarray(self.counts, dtype=np.float64) / self.slots
+        return {
+            "items": len(self),
+            "shards": self.n_shards,
+            "slots": self.slots * self.n_shards,
+            "fp_bits": self.fp_bits,
+            "load": float(loads.mean()),
+            "max_shard_load": float(loads.max()),
+            "lookups": self.lookups,
+            "probes": self.probes,
+            "mean_probes": self.probes / self.lookups if self.lookups else 0.0,
+            "max_probes": self.max_probes,
+            "false_positive_rate": false_positive_rate(self.fp_bits, float(loads.max())),
+        }
+
+    def flush(self):
+        if not self.readonly:
+            for table in self.tables:
+                table.flush()
+            self.counts.flush()
+
+    def close(self):
+        self.flush()
+        self.tables = []
+        self.counts = None
+
+
+# Producer side pre-filter: drops songs the store already has and songs
+# this producer sent recently (a direct-mapped cache of its own hashes),
+# so fewer duplicates go through the queue
+class ProducerFilter:
+    def __init__(self, path, recent_bits=16):
+        self.store = UniqueStore(path, readonly=True)
+        self.recent = np.zeros(1 << recent_bits, dtype=np.uint64)
+        self.recent_mask = np.uint64((1 << recent_bits) - 1)
+        self.dropped = 0
+
+    # Returns a bool array, True for each hash worth sending
+    def filter_batch(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        slots = (hashes & self.recent_mask).astype(np.intp)
+        keep = (self.recent[slots] != hashes) & ~self.store.contains_batch(hashes)
+        self.recent[slots[keep]] = hashes[keep]
+        self.dropped += int(len(hashes) - keep.sum())
+        return keep
@@ -0,0 +1,211 @@
+import struct
+
+from sync import (SCALE, SYNC_RUNNING, SENT_SYNCDONE,
+                  OpenSync16, CloseSync16, StartSync16, GetTempo16,
+                  AllocMidiOutBuffer, AttachMidiOut16, MidiClock, syncTimer, timeKillEvent, timeEndPeriod)
+
+
+#-----------------------------------------------------------------------------
+# Virtual clock
+#
+# Drives an opened sync device from simulated time instead of the
+# multimedia timer. Each step does exactly what a timer interrupt does
+# (syncTimer -> sync()), so the tempo and tick arithmetic is the same as
+# in real time, but steps run as fast as the CPU allows. In S_MIDI mode an
+# external master is simulated by calling MidiClock() at the master's
+# clock times.
+#
+# Everything sent to the virtual outputs is captured with the millisecond
+# position and tick count at which sync() sent it, which gives faster than
+# real time rendering to a Standard MIDI File and timing checks that run
+# in milliseconds.
+#-----------------------------------------------------------------------------
+
+class VirtualMidiOut:
+    def __init__(self, lpSync, nMidiOutSize, dwFlags=0, hWnd=None):
+        self.lpSync = lpSync
+        self.hMidiOut = self            # messages to this output are captured below
+        self.hWnd = hWnd
+        self.dwFlags = dwFlags
+        self.dwLastEventTicks = 0
+        self.messages = []              # (msPosition, dwTicks, dwMsg)
+        self.sysex = []                 # (msPosition, dwTicks, bytes), one per chunk
+        self.writes = 0                 # number of Write transfers
+        self.bRunningStatus = 0
+        AllocMidiOutBuffer(self, nMidiOutSize)
+
+    def ShortMsg(self, dwMsg):
+        self.messages.append((self.lpSync.msPosition, self.lpSync.dwTicks, dwMsg))
+        return 0
+
+    def LongMsg(self, data):
+        self.sysex.append((self.lpSync.msPosition, self.lpSync.dwTicks, bytes(data)))
+        return 0
+
+    #-------------------------------------------------------------------------
+    # Write
+    # Splits a byte string of short messages, which may use running
+    # status, back into messages as if each had been sent by ShortMsg.
+    #-------------------------------------------------------------------------
+    def Write(self, data):
+        self.writes += 1
+        i = 0
+        while i < len(data):
+            status = data[i]
+            if status >= 0xF8:
+                # Real-time messages don't affect running status
+                self.ShortMsg(status)
+                i += 1
+                continue
+
+            if status & 0x80:
+                self.bRunningStatus = status
+                i += 1
+            else:
+                status = self.bRunningStatus
+
+            nData = 1 if (status & 0xF0) in (0xC0, 0xD0) else 2
+            dwMsg = status
+            for nShift in range(nData):
+                dwMsg |= data[i + nShift] << (8 * (nShift + 1))
+            self.ShortMsg(dwMsg)
+            i += nData
+        return 0
+
+
+class VirtualClock:
+    def __init__(self, mode="S_INT", wTimerPeriod=1, hWnd=None):
+        self.hWnd = hWnd
+        self.posted = []                # (msPosition, msg)
+        self.tempos = []                # (dwTicks, uSPerBeat)
+        self.outputs = []
+
+        self.lpSync = OpenSync16(0, self.PostMessage, mode, wTimerPeriod)
+
+        # Steps replace the timer interrupts
+        timeKillEvent(self.lpSync.wTimerID)
+        timeEndPeriod(self.lpSync.wTimerPeriod)
+        self.lpSync.wTimerID = None
+
+    def PostMessage(self, msg, wParam, lParam):
+        self.posted.append((self.lpSync.msPosition, msg))
+        if callable(self.hWnd):
+            self.hWnd(msg, wParam, lParam)
+
+    def AddOutput(self, nMidiOutSize=1024, dwFlags=0):
+        lpMO = VirtualMidiOut(self.lpSync, nMidiOutSize, dwFlags, self.PostMessage)
+        AttachMidiOut16(self.lpSync, lpMO)
+        self.outputs.append(lpMO)
+        return lpMO
+
+    def Start(self, dwStartTicks=0):
+        StartSync16(self.lpSync, dwStartTicks)
+        self.tempos = [(dwStartTicks, GetTempo16(self.lpSync))]
+
+    def Close(self):
+        CloseSync16(self.lpSync)
+
+    #-------------------------------------------------------------------------
+    # Step
+    # Runs n timer interrupts, recording any tempo change they make.
+    #-------------------------------------------------------------------------
+    def Step(self, n=1):
+        lpSync = self.lpSync
+        for _ in range(n):
+            dwTempo = lpSync.dwTempo
+            syncTimer(lpSync.wTimerID, 0, lpSync, 0, 0)
+            if lpSync.dwTempo != dwTempo:
+                self.tempos.append((lpSync.dwTicks, lpSync.dwTempo // SCALE))
+
+    #-------------------------------------------------------------------------
+    # RunUntilDone
+    # Steps until sync() reports SYNC_DONE or msLimit is reached. Returns
+    # the final position in ms.
+    #-------------------------------------------------------------------------
+    def RunUntilDone(self, msLimit=3600000):
+        lpSync = self.lpSync
+        while (lpSync.wFlags & SENT_SYNCDONE) == 0 and lpSync.msPosition < msLimit:
+            self.Step()
+        return lpSync.msPosition
+
+    #-------------------------------------------------------------------------
+    # RunMidiSlave
+    # Simulates an external master running at uSPerBeat for msLength ms.
+    # The master's MIDI_START sets the device running and a MIDI clock is
+    # delivered every 1/24 beat, interleaved with the timer interrupts.
+    # uSJitter, if given, is a function of the clock index returning an
+    # offset in uS to apply to that clock.
+    #-------------------------------------------------------------------------
+    def RunMidiSlave(self, uSPerBeat, msLength, uSJitter=None):
+        lpSync = self.lpSync
+        lpSync.wFlags |= SYNC_RUNNING
+
+        uSPerClock = uSPerBeat / 24.0
+        uSNow = 0
+        nClock = 1
+        while uSNow < msLength * 1000:
+            uSClock = nClock * uSPerClock
+            if uSJitter is not None:
+                uSClock += uSJitter(nClock)
+
+            if uSClock <= uSNow:
+                MidiClock(lpSync, int(uSClock * 1000))
+                nClock += 1
+            else:
+                self.Step()
+                uSNow += lpSync.wTimerPeriod * 1000
+
+        return nClock - 1
+
+    def Messages(self):
+        messages = []
+        for lpMO in self.outputs:
+            messages.extend(lpMO.messages)
+        messages.sort(key=lambda message: message[1])
+        return messages
+
+    def SaveMidiFile(self, filename):
+        WriteMidiFile(filename, self.lpSync.wResolution, self.Messages(), self.tempos)
+
+
+#-----------------------------------------------------------------------------
+# WriteMidiFile
+#
+# Writes captured messages as a format 0 Standard MIDI File. messages are
+# (msPosition, dwTicks, dwMsg) tuples in tick order and tempos are
+# (dwTicks, uSPerBeat) tuples. Real-time messages (MIDI clock, start and
+# stop) are not allowed in files and are left out.
+#-----------------------------------------------------------------------------
+def WriteMidiFile(filename, wResolution, messages, tempos):
+    events = []
+    for dwTicks, uSPerBeat in tempos:
+        events.append((dwTicks, b"\xff\x51\x03" + uSPerBeat.to_bytes(3, "big")))
+
+    for _, dwTicks, dwMsg in messages:
+        status = dwMsg & 0xFF
+        if status >= 0xF0:
+            continue
+        nBytes = 2 if (status & 0xF0) in (0xC0, 0xD0) else 3
+        events.append((dwTicks, (dwMsg & 0xFFFFFF).to_bytes(4, "little")[:nBytes]))
+
+    events.sort(key=lambda event: event[0])
+
+    track = bytearray()
+    dwLastTicks = 0
+    for dwTicks, data in events:
+        track += VarLen(dwTicks - dwLastTicks) + data
+        dwLastTicks = dwTicks
+    track += b"\x00\xff\x2f\x00"
+
+    with open(filename, "wb") as output_file:
+        output_file.write(b"MThd" + struct.pack(">IHHH", 6, 0, 1, wResolution))
+        output_file.write(b"MTrk" + struct.pack(">I", len(track)) + bytes(track))
+
+
+def VarLen(value):
+    data = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        data.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(data)
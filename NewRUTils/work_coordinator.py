@@ -0,0 +1,108 @@
+import multiprocessing
+import time
+
+CLAIM_POLL = 0.1    # seconds between claims while the target is covered
+
+
+#////////////////////////////////////////////////////////////////////////
+#///////////////////// WORK COORDINATOR /////////////////////////////////
+#////////////////////////////////////////////////////////////////////////
+
+# Shares a run's song target among producer processes, so producers stop
+# once the consumer has its target instead of running until killed.
+#
+# Producers claim work a quota at a time. claim() hands out at most the
+# songs still missing (target plus any given back, minus claimed), waits
+# while there are none, and returns nothing once the run has stopped, so
+# a producer finishes its quota and exits. Songs that are claimed but do
+# not count are given back, which lets producers claim them again:
+#
+#   give_back   songs a producer's pre-filter dropped
+#   accept      the consumer's new songs; its duplicates are given back
+#
+# The first claimed song number doubles as an index into the song space,
+# so enumerating producers (song_index) get disjoint ranges from the
+# same counter.
+#
+# accept() sets the stop event when the target is reached. Producers
+# blocked on a full transport ring look at the event and give up; songs
+# still in flight are drained by the consumer and counted as discarded.
+# All counters live in shared memory under one lock.
+
+
+class WorkCoordinator:
+    # Counter slots
+    CLAIMED, RETURNED, ACCEPTED, DUPLICATES, DISCARDED = range(5)
+
+    def __init__(self, target, quota=4096):
+        self.target = target
+        self.quota = quota
+        self.lock = multiprocessing.Lock()
+        self.counters = multiprocessing.Array("q", 5, lock=False)
+        self.stop_event = multiprocessing.Event()
+        self.start_time = multiprocessing.Value("d", time.time(), lock=False)
+
+    def start(self):
+        self.start_time.value = time.time()
+
+    # Claims up to n songs (default one quota). Returns (start, count).
+    # While the target is covered but not yet met (songs in flight may
+    # still be given back) it waits, so count is 0 only once the run has
+    # stopped
+    def claim(self, n=None):
+        n = self.quota if n is None else n
+        while True:
+            with self.lock:
+                counters = self.counters
+                start = counters[self.CLAIMED]
+                if self.stop_event.is_set():
+                    return start, 0
+                count = max(0, min(n, self.target + counters[self.RETURNED] - start))
+                if count:
+                    counters[self.CLAIMED] = start + count
+                    return start, count
+            self.stop_event.wait(CLAIM_POLL)
+
+    def give_back(self, n):
+        if n:
+            with self.lock:
+                self.counters[self.RETURNED] += n
+
+    # Records n new songs and the duplicates the consumer dropped; returns
+    # True (and stops the run) once the target is reached
+    def accept(self, n, duplicates=0):
+        with self.lock:
+            counters = self.counters
+            counters[self.ACCEPTED] += n
+            counters[self.DUPLICATES] += duplicates
+            counters[self.RETURNED] += duplicates
+            done = counters[self.ACCEPTED] >= self.target
+        if done:
+            self.stop_event.set()
+        return done
+
+    def discard(self, n):
+        if n:
+            with self.lock:
+                self.counters[self.DISCARDED] += n
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stopped(self):
+        return self.stop_event.is_set()
+
+    def stats(self):
+        with self.lock:
+            claimed, returned, accepted, duplicates, discarded = self.counters[:]
+        elapsed = time.time() - self.start_time.value
+        return {
+            "target": self.target,
+            "claimed": claimed,
+            "given_back": returned,
+            "accepted": accepted,
+            "duplicates": duplicates,
+            "discarded": discarded,
+            "seconds": elapsed,
+            "songs_per_sec": accepted / elapsed if elapsed > 0 else 0.0,
+        }